@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Flag anomalous data in combined cave site series.
+
+Rather than truncating files at the first value outside fixed limits (see
+`hobo_truncate_bad_files.py`), this runs vectorized rolling-window tests
+over each entire series and writes the results to a compact "flags"
+sidecar, `CAVE_site_flags.csv`, one row per run of consecutive flagged
+records. The data itself is left untouched.
+
+Flags:
+
+    spike        deviates from its neighbors by many times the rolling noise level
+    rate         changes faster than physically plausible between samples
+    flatline     sensor reports an identical value for an extended period
+    saturated    RH sits at 100% for an extended period (condensation)
+    drift        step change in temperature or RH level across a logger swap
+    limit        outside our fixed QC limits
+    end_failure  everything from a deployment's first limit failure to its end
+                 (reported for variable "All")
+
+hobo_anomaly.py
+    Flag all combined CAVE_site.csv files in the current directory
+
+hobo_anomaly.py CAVE_site.csv...
+    Flag just the specified files
+"""
+
+import os, os.path
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+from hobo_truncate_bad_files import MIN_VOLTAGE, MAX_TEMP, MIN_TEMP, MIN_RH
+
+
+VARIABLES = ['Temperature', 'RH', 'Battery']
+FLAG_COLUMNS = ['VARIABLE', 'FLAG', 'START', 'END', 'COUNT', 'DETAIL']
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+
+SPIKE_WINDOW_HRS = 24     # rolling window over which typical sample-to-sample noise is measured
+SPIKE_MADS = 6.0          # deviation threshold, in (scaled) median absolute deviations
+FLATLINE_HRS = 48         # identical readings for this long are a flatline
+DRIFT_WINDOW_HRS = 24     # compare this much data on each side of a logger swap
+DRIFT_MADS = 8.0          # step threshold, in (scaled) MADs of the daily data
+SATURATED_RH = 99.5
+
+# minimum deviation worth flagging, and maximum plausible rate of change per hour, per variable
+MIN_DEVIATION = {'Temperature': 1.0, 'RH': 3.0, 'Battery': 0.05}
+MAX_RATE = {'Temperature': 15.0, 'RH': 40.0, 'Battery': 0.5}
+
+MAD_SCALE = 1.4826  # scales MAD to be comparable with a standard deviation
+
+
+def flags_fname(fname):
+    """Flags sidecar filename for a combined cave site file"""
+    return os.path.splitext(fname)[0] + '_flags.csv'
+
+
+def coverage_ids(frame, ids, names, coverage):
+    """
+    Correct file-order deployment IDs using a coverage index. Once combined
+    files are sorted, rows of overlapping deployments interleave, so a row is
+    assigned to the deployment whose extent covers it and whose sampling
+    phase it matches, preferring its file-order ID if still ambiguous.
+    """
+    import numpy as np
+    times = frame['DateTime'].values.astype('datetime64[s]').astype(np.int64)
+    id_by_name = dict((name, i) for i, name in enumerate(names))
+    best, best_score = ids.copy(), np.zeros(len(frame), dtype=np.int8)
+    deployments = coverage[coverage['KIND'] == 'deployment']
+    for name, start, end, interval in zip(deployments['FILE'], deployments['START'].values,
+                                          deployments['END'].values, deployments['INTERVAL_S']):
+        if name not in id_by_name:
+            continue
+        dep_id = id_by_name[name]
+        start, end = [np.datetime64(t, 's').astype(np.int64) for t in (start, end)]
+        covered = (times >= start) & (times <= end)
+        in_phase = (times - start) % interval == 0 if interval else np.ones(len(frame), dtype=bool)
+        score = covered * (1 + 4 * in_phase + 2 * (ids == dep_id)).astype(np.int8)
+        better = score >= np.maximum(best_score, 1)  # ties go to the later-starting deployment
+        best[better], best_score[better] = dep_id, score[better]
+    return best
+
+
+def load(fname):
+    """
+    Load a combined cave site file for anomaly detection, with the
+    deployment ID of each row. Rows are sorted by time within each
+    deployment, and deployments by their start time, so each deployment's
+    records are contiguous even where deployments overlap.
+    """
+    import numpy as np
+    import pandas as pd
+    import hobo_coverage
+    frame = pd.read_csv(fname, usecols=['DateTime'] + VARIABLES + ['FileStart'], dtype={'FileStart': object})
+    frame['DateTime'] = pd.to_datetime(frame['DateTime'], format=TIME_FMT)
+    ids, names = hobo_coverage.deployment_ids(frame)  # in file order, before any sorting
+    coverage = hobo_coverage.load_coverage(hobo_coverage.coverage_fname(fname))
+    if coverage is not None and len(frame):
+        ids = coverage_ids(frame, ids, names, coverage)
+    frame['Deployment'] = ids
+    frame['DeploymentStart'] = frame.groupby('Deployment')['DateTime'].transform('min')
+    frame.sort_values(['DeploymentStart', 'Deployment', 'DateTime'], kind='mergesort', inplace=True)
+    frame.reset_index(drop=True, inplace=True)
+    return frame
+
+
+def _window(hours, interval_s):
+    """Number of samples spanning `hours`, odd so that windows center on a sample"""
+    n = max(3, int(round(hours * 3600.0 / interval_s)))
+    return n + 1 - n % 2
+
+
+def _runs(mask):
+    """(start index, end index) of each run of True values in a boolean array"""
+    import numpy as np
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1)
+
+
+def detect(frame):
+    """
+    Run all anomaly tests over a combined series.
+
+    :param frame:  series with deployment IDs, each deployment contiguous and sorted by time, see `load()`
+    :return: dict of (variable, flag) -> (boolean mask, per-row detail values)
+    """
+    import numpy as np
+    import pandas as pd
+
+    results = {}
+    if len(frame) < 3:
+        return results
+
+    times = frame['DateTime'].values.astype('datetime64[s]').astype(np.int64)
+    dt = np.diff(times).astype(float)
+    interval = float(np.median(dt)) or 60.0
+    deployment = frame['Deployment'].values
+    new_deployment = np.concatenate(([True], deployment[1:] != deployment[:-1]))
+
+    spike_window = _window(SPIKE_WINDOW_HRS, interval)
+    flat_count = int(FLATLINE_HRS * 3600.0 / interval)
+    drift_window = _window(DRIFT_WINDOW_HRS, interval)
+
+    for var in VARIABLES:
+        series = frame[var]
+        if series.isnull().all():
+            continue
+        values = series.values
+
+        # spikes: deviation from the mean of a sample's neighbors (which cancels out
+        # the daily cycle), as a robust z-score against that deviation's rolling MAD
+        dev = (series - (series.shift(1) + series.shift(-1)) / 2.0).abs()
+        dev[new_deployment | np.roll(new_deployment, -1)] = np.nan
+        mad = dev.rolling(spike_window, center=True, min_periods=3).median() * MAD_SCALE
+        threshold = np.maximum(SPIKE_MADS * mad.values, MIN_DEVIATION[var])
+        with np.errstate(invalid='ignore'):
+            spike = dev.values > threshold
+        results[var, 'spike'] = spike, dev.values
+
+        # rate of change, per hour, within a deployment
+        rate = np.concatenate(([0.0], np.abs(np.diff(values)) / (dt / 3600.0)))
+        rate[new_deployment] = 0.0
+        rate_mask = np.nan_to_num(rate) > MAX_RATE[var]
+        results[var, 'rate'] = rate_mask, rate
+
+        # flatlines: runs of identical values, RH at 100% is reported separately
+        changed = np.concatenate(([True], values[1:] != values[:-1])) | new_deployment
+        run_id = changed.cumsum()
+        run_len = np.bincount(run_id)[run_id]
+        flat = (run_len >= flat_count) & ~np.isnan(values)
+        if var == 'RH':
+            saturated = flat & (values >= SATURATED_RH)
+            results[var, 'saturated'] = saturated, run_len * interval / 3600.0
+            flat &= ~saturated
+        results[var, 'flatline'] = flat, run_len * interval / 3600.0
+
+        # drift: step in rolling median level across a logger swap (a fresh battery is expected to step)
+        if var == 'Battery':
+            continue
+        before = series.rolling(drift_window, min_periods=3).median().shift(1).values
+        after = series[::-1].rolling(drift_window, min_periods=3).median()[::-1].values
+        spread = dev.rolling(drift_window, min_periods=3).median().values * MAD_SCALE
+        step = np.abs(after - before)
+        with np.errstate(invalid='ignore'):
+            drift = new_deployment & (np.arange(len(values)) > 0) & \
+                    (step > np.maximum(DRIFT_MADS * np.nan_to_num(spread), 2 * MIN_DEVIATION[var]))
+        results[var, 'drift'] = drift, step
+
+    # fixed QC limits, and failures which persist to the end of a deployment
+    temp, rh, batt = frame['Temperature'].values, frame['RH'].values, frame['Battery'].values
+    with np.errstate(invalid='ignore'):
+        limits = {
+            'Temperature': (temp > MAX_TEMP) | (temp < MIN_TEMP),
+            'RH': rh <= MIN_RH,
+            'Battery': batt < MIN_VOLTAGE,
+        }
+    any_limit = np.zeros(len(frame), dtype=bool)
+    for var, mask in limits.items():
+        results[var, 'limit'] = mask, frame[var].values
+        any_limit |= mask
+    failed = pd.Series(any_limit.astype(np.int8)).groupby(deployment).cummax().values.astype(bool)
+    results['All', 'end_failure'] = failed, np.zeros(len(frame))
+
+    return results
+
+
+def flag_runs(frame, results):
+    """
+    Collapse per-row flags into a compact DataFrame with one row per run of
+    consecutive flagged records. DETAIL is the run's largest detail value
+    (eg. deviation, rate, duration in hours).
+    """
+    import numpy as np
+    import pandas as pd
+
+    records = []
+    for (var, flag), (mask, detail) in sorted(results.items()):
+        if not mask.any():
+            continue
+        detail = np.abs(np.nan_to_num(np.asarray(detail, dtype=float)))
+        for start, end in _runs(mask):
+            records.append((var, flag, start, end, end - start + 1, round(detail[start:end + 1].max(), 3)))
+    flags = pd.DataFrame.from_records(records, columns=FLAG_COLUMNS)
+    for col in 'START', 'END':
+        flags[col] = frame['DateTime'].values[flags[col].values.astype(int)]
+    flags.sort_values(['START', 'VARIABLE', 'FLAG'], kind='mergesort', inplace=True)
+    flags[['START', 'END']] = flags[['START', 'END']].apply(lambda col: col.dt.strftime(TIME_FMT))
+    return flags.reset_index(drop=True)
+
+
+def process(fname):
+    """Flag a single combined file and write its sidecar, return the flags DataFrame"""
+    with metrics.file(fname) as rec:
+        frame = load(fname)
+        rec.rows = len(frame)
+        flags = flag_runs(frame, detect(frame))
+        outfname = flags_fname(fname)
+        flags.to_csv(outfname, index=False)
+        rec.bytes_written = os.path.getsize(outfname)
+    return flags
+
+
+def _process(fname):
+    """Pool worker: returns (fname, {flag: flagged record count}, metrics records)"""
+    with metrics.collect() as records:
+        flags = process(fname)
+    return fname, flags.groupby('FLAG')['COUNT'].sum().to_dict(), records
+
+
+def main(fnames, jobs=1):
+    if not fnames:
+        from glob import glob
+        from hobo_combine_all import is_site_fname
+        fnames = sorted(filter(is_site_fname, glob('*.csv')))
+
+    with metrics.stage('anomaly'):
+        if jobs > 1:
+            from multiprocessing import Pool
+            pool = Pool(jobs)
+            results = pool.imap(_process, fnames)
+        else:
+            results = (_process(fname) for fname in fnames)
+
+        for fname, counts, records in results:
+            if jobs > 1:
+                metrics.merge(records)
+            print '%s: %s' % (fname, ', '.join('%d %s' % (n, flag) for flag, n in sorted(counts.items())) or 'OK')
+
+        if jobs > 1:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Flag anomalous data in combined cave site series')
+    parser.add_argument('fnames', metavar='CAVE_site.csv', nargs='*', help='combined files to flag (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of files to process in parallel')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.fnames, args.jobs)
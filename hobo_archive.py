@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+Compact, compressed archival encoding of combined cave site files.
+
+A combined `CAVE_site.csv` spells out the full timestamp and its derived
+Year/Month/Day/ISO columns on every row, and stores each sensor value as
+text. Logger data is sampled at a fixed interval, so almost all of that is
+redundant. An archive file, `CAVE_site.hca`, instead stores the series as
+a sequence of independently compressed blocks, starting a new block at each
+deployment (`FileStart`) and every `BLOCK_ROWS` rows. Each block holds:
+
+- timestamps as a start time plus run-length encoded (count, step) pairs,
+  which is a single run for an uninterrupted deployment
+- sensor values as scaled integers (thousandths of a degree or percent RH,
+  hundredths of a volt), delta encoded, byte-shuffled, with a packed bitmap
+  of missing values
+- `FileStart` markers, and the literal text of any row which wouldn't
+  otherwise reproduce exactly
+
+Decoding reproduces the original CSV byte for byte; `encode()` verifies
+this as it goes. Blocks may be streamed one at a time with `iter_blocks()`,
+as CSV lines with `iter_lines()`, or loaded straight into a DataFrame
+without any text parsing with `load_frame()`.
+
+hobo_archive.py CAVE_site.csv...
+    Encode combined files as CAVE_site.hca archives
+
+hobo_archive.py CAVE_site.hca...
+    Decode archives back to CAVE_site.csv files, which mustn't already exist
+    (an error is reported for each which does, and the exit status is 1)
+
+hobo_archive.py --force CAVE_site.hca...
+    Decode archives, overwriting any existing CAVE_site.csv files
+"""
+
+import sys, os, os.path
+import json
+import struct
+import zlib
+from calendar import timegm
+from datetime import date
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+
+ARCHIVE_EXT = '.hca'
+MAGIC = 'HOBOARC1'
+BLOCK_ROWS = 65536
+COMPRESSION_LEVEL = 9
+
+VARIABLES = ['Temperature', 'RH', 'Battery']
+SCALES = {'Temperature': 1000, 'RH': 1000, 'Battery': 100}  # matches the `%.3f` / `%.2f` of `combine_file()`
+FORMATS = {'Temperature': '%.3f', 'RH': '%.3f', 'Battery': '%.2f'}
+
+_BLOCK_HEADER = struct.Struct('<II')  # compressed length, rows
+_LENGTH = struct.Struct('<I')
+
+
+def archive_fname(fname):
+    """Archive filename for a combined cave site file"""
+    return os.path.splitext(fname)[0] + ARCHIVE_EXT
+
+
+def _parse_row(line):
+    """Parse a combined CSV line into (epoch seconds, [scaled value or None, ...], FileStart)"""
+    fields = line.split(',')
+    if len(fields) != 10:
+        raise ValueError(line)
+    dt = fields[0]
+    ts = timegm((int(dt[0:4]), int(dt[5:7]), int(dt[8:10]), int(dt[11:13]), int(dt[14:16]), int(dt[17:19])))
+    values = [int(round(float(text) * SCALES[var])) if text else None for var, text in zip(VARIABLES, fields[6:9])]
+    return ts, values, fields[9]
+
+
+def _shuffle(ints):
+    """Byte-transpose an int32 array, which groups the mostly-zero high bytes of small deltas together"""
+    import numpy as np
+    return ints.astype('<i4').view(np.uint8).reshape(-1, 4).T.tobytes()
+
+def _unshuffle(buf, n):
+    import numpy as np
+    return np.frombuffer(buf, dtype=np.uint8).reshape(4, n).T.copy().view('<i4').ravel()
+
+
+class Block(object):
+    """
+    A decoded block of consecutive rows.
+
+    :ivar times:  int64 epoch seconds of each row
+    :ivar dict values:  int64 scaled integer values per variable (undefined where missing)
+    :ivar dict missing:  boolean mask per variable
+    :ivar dict file_starts:  row -> FileStart filename
+    :ivar dict literals:  row -> verbatim CSV text
+    """
+
+    def __init__(self, times, values, missing, file_starts=None, literals=None):
+        self.times, self.values, self.missing = times, values, missing
+        self.file_starts = file_starts or {}
+        self.literals = literals or {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def encode(self):
+        """Serialize and compress this block"""
+        import numpy as np
+        n = len(self.times)
+        steps = np.diff(self.times)
+        change = np.flatnonzero(np.diff(steps)) + 1
+        run_starts = np.concatenate(([0], change)) if len(steps) else np.array([], dtype=int)
+        run_counts = np.diff(np.concatenate((run_starts, [len(steps)])))
+        meta = {
+            'rows': n,
+            'start': int(self.times[0]),
+            'runs': [[int(count), int(steps[i])] for i, count in zip(run_starts, run_counts)],
+            'file_starts': sorted([int(row), name] for row, name in self.file_starts.items()),
+            'literals': sorted([int(row), text] for row, text in self.literals.items()),
+        }
+        meta = json.dumps(meta, separators=(',', ':'))
+        parts = [_LENGTH.pack(len(meta)), meta]
+        for var in VARIABLES:
+            missing = self.missing[var]
+            filled = self.values[var].copy()
+            filled[missing] = 0
+            if missing.any():
+                # carry the previous value through gaps, so they encode as zero deltas
+                idx = np.where(~missing, np.arange(n), 0)
+                filled = filled[np.maximum.accumulate(idx)]
+            parts.append(np.packbits(missing).tobytes())
+            parts.append(_shuffle(np.diff(np.concatenate(([0], filled)))))
+        payload = zlib.compress(''.join(parts), COMPRESSION_LEVEL)
+        return _BLOCK_HEADER.pack(len(payload), n) + payload
+
+    @classmethod
+    def decode(cls, payload, n):
+        """Decompress and deserialize a block of `n` rows"""
+        import numpy as np
+        buf = zlib.decompress(payload)
+        meta_len, = _LENGTH.unpack_from(buf)
+        pos = _LENGTH.size + meta_len
+        meta = json.loads(buf[_LENGTH.size:pos])
+
+        steps = np.repeat([step for count, step in meta['runs']], [count for count, step in meta['runs']])
+        times = meta['start'] + np.concatenate(([0], np.cumsum(steps, dtype=np.int64)))
+        values, missing = {}, {}
+        nbits = (n + 7) // 8
+        for var in VARIABLES:
+            missing[var] = np.unpackbits(np.frombuffer(buf, dtype=np.uint8, count=nbits, offset=pos))[:n].astype(bool)
+            pos += nbits
+            values[var] = np.cumsum(_unshuffle(buf[pos:pos + 4 * n], n), dtype=np.int64)
+            pos += 4 * n
+        return cls(times, values, missing,
+                   dict((row, name.encode('utf-8')) for row, name in meta['file_starts']),
+                   dict((row, text.encode('utf-8')) for row, text in meta['literals']))
+
+    def _date_fields(self):
+        """DateTime date prefix and Year/Month/Day/ISO fields for each row, computed once per day"""
+        import numpy as np
+        days, inverse = np.unique(self.times // 86400, return_inverse=True)
+        fields = []
+        for day in days:
+            d = date.fromordinal(int(day) + 719163)  # 1970-01-01
+            iso_year, iso_week, _ = d.isocalendar()
+            fields.append((d.strftime('%Y-%m-%d'), ','.join((d.strftime('%Y'), d.strftime('%m'), d.strftime('%d'), str(iso_year), str(iso_week)))))
+        return [fields[i] for i in inverse]
+
+    def lines(self):
+        """Reconstruct this block's CSV lines (without line endings)"""
+        secs = (self.times % 86400).tolist()
+        columns = []
+        for var in VARIABLES:
+            fmt, scale = FORMATS[var], float(SCALES[var])
+            columns.append([('' if m else fmt % (v / scale)) for v, m in zip(self.values[var].tolist(), self.missing[var].tolist())])
+        lines = []
+        for i, ((day, date_fields), sec, temp, rh, batt) in enumerate(zip(self._date_fields(), secs, *columns)):
+            if i in self.literals:
+                lines.append(self.literals[i])
+                continue
+            lines.append('%s %02d:%02d:%02d,%s,%s,%s,%s,%s' % (day, sec // 3600, sec // 60 % 60, sec % 60, date_fields,
+                                                               temp, rh, batt, self.file_starts.get(i, '')))
+        return lines
+
+    def frame(self):
+        """This block as a DataFrame, in the same form as a combined CSV read by Pandas"""
+        import numpy as np
+        import pandas as pd
+        columns = ['Year', 'Month', 'Day', 'ISO_Year', 'ISO_Week']
+        data = {}
+        days, inverse = np.unique(self.times // 86400, return_inverse=True)
+        dates = [date.fromordinal(int(day) + 719163) for day in days]
+        for col, values in zip(columns, zip(*[(d.year, d.month, d.day) + d.isocalendar()[:2] for d in dates])):
+            data[col] = np.array(values, dtype=np.int64)[inverse]
+        for var in VARIABLES:
+            data[var] = np.where(self.missing[var], np.nan, self.values[var] / float(SCALES[var]))
+        starts = np.empty(len(self), dtype=object)
+        starts[:] = np.nan
+        for row, name in self.file_starts.items():
+            starts[row] = name
+        data['FileStart'] = starts
+        index = pd.DatetimeIndex(self.times.astype('datetime64[s]'), name='DateTime')
+        return pd.DataFrame(data, index=index, columns=columns + VARIABLES + ['FileStart'])
+
+
+def _make_block(rows):
+    """Build a `Block` from parsed (line, epoch, values, FileStart) rows"""
+    import numpy as np
+    n = len(rows)
+    times = np.array([ts for line, ts, values, file_start in rows], dtype=np.int64)
+    values, missing = {}, {}
+    for j, var in enumerate(VARIABLES):
+        col = [r[2][j] for r in rows]
+        missing[var] = np.array([v is None for v in col], dtype=bool)
+        values[var] = np.array([0 if v is None else v for v in col], dtype=np.int64)
+    file_starts = dict((i, r[3]) for i, r in enumerate(rows) if r[3])
+    block = Block(times, values, missing, file_starts)
+    # any row which doesn't reproduce exactly is kept verbatim
+    for i, (line, decoded) in enumerate(zip([r[0] for r in rows], block.lines())):
+        if line != decoded:
+            block.literals[i] = line
+    return block
+
+
+def encode(fname, outfname=None, block_rows=BLOCK_ROWS):
+    """
+    Encode a combined CSV file as an archive.
+
+    :return: archive filename
+    """
+    outfname = outfname or archive_fname(fname)
+    with open(fname, 'rb') as f:
+        text = f.read()
+    newline = '\r\n' if '\r\n' in text[:4096] else '\n'
+    final_newline = text.endswith(newline)
+    lines = text.split(newline)
+    if final_newline:
+        lines.pop()
+    header, lines = lines[0], lines[1:]
+    import hobo_psychro
+    if set(header.split(',')) & set(hobo_psychro.DERIVED_COLUMNS):
+        raise ValueError('%s has derived psychrometric columns, remove them with `hobo_psychro.py --strip` before archiving' % fname)
+
+    with open(outfname, 'wb') as outf:
+        meta = json.dumps({'header': header, 'newline': newline, 'final_newline': final_newline,
+                           'rows': len(lines), 'source': os.path.basename(fname)})
+        outf.write(MAGIC + _LENGTH.pack(len(meta)) + meta)
+
+        rows, prev_ts = [], 0
+        for line in lines:
+            try:
+                ts, values, file_start = _parse_row(line)
+            except ValueError:
+                ts, values, file_start = prev_ts, [None] * len(VARIABLES), ''  # kept as a literal
+            if rows and (file_start or len(rows) >= block_rows):
+                outf.write(_make_block(rows).encode())
+                rows = []
+            rows.append((line, ts, values, file_start))
+            prev_ts = ts
+        if rows:
+            outf.write(_make_block(rows).encode())
+    return outfname
+
+
+def read_header(f):
+    """Read and validate the archive header from an open archive file"""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a HOBO archive file: %s' % getattr(f, 'name', f))
+    meta_len, = _LENGTH.unpack(f.read(_LENGTH.size))
+    meta = json.loads(f.read(meta_len))
+    meta['header'], meta['newline'] = meta['header'].encode('utf-8'), meta['newline'].encode('utf-8')
+    return meta
+
+
+def iter_blocks(fname):
+    """Stream the decoded `Block`s of an archive file, one at a time"""
+    with open(fname, 'rb') as f:
+        read_header(f)
+        while True:
+            head = f.read(_BLOCK_HEADER.size)
+            if not head:
+                break
+            length, n = _BLOCK_HEADER.unpack(head)
+            yield Block.decode(f.read(length), n)
+
+
+def iter_lines(fname):
+    """Stream the CSV lines of an archive file, header first, without line endings"""
+    with open(fname, 'rb') as f:
+        yield read_header(f)['header']
+    for block in iter_blocks(fname):
+        for line in block.lines():
+            yield line
+
+
+def decode(fname, outfname=None, force=False):
+    """
+    Decode an archive file back to its original combined CSV.
+
+    :param bool force:  overwrite the CSV if it already exists (it may be newer than the archive)
+    :return: CSV filename
+    """
+    with open(fname, 'rb') as f:
+        meta = read_header(f)
+    outfname = outfname or os.path.splitext(fname)[0] + '.csv'
+    if os.path.exists(outfname) and not force:
+        raise ValueError('Refusing to overwrite existing %s with the contents of %s' % (outfname, fname))
+    newline = meta['newline']
+    with open(outfname, 'wb') as outf:
+        lines = iter_lines(fname)
+        outf.write(next(lines))
+        for line in lines:
+            outf.write(newline + line)
+        if meta['final_newline']:
+            outf.write(newline)
+    return outfname
+
+
+def load_frame(fname):
+    """Load an archive file into a DataFrame indexed by DateTime, sorted like `hobo_plot.load()`"""
+    import pandas as pd
+    frame = pd.concat([block.frame() for block in iter_blocks(fname)])
+    frame.sort_index(inplace=True)
+    return frame
+
+
+def main(fnames, verify=False, force=False):
+    """Encode or decode each file, return the number which failed"""
+    if not fnames:
+        from glob import glob
+        from hobo_combine_all import is_site_fname
+        fnames = sorted(filter(is_site_fname, glob('*.csv')))
+
+    failures = 0
+    with metrics.stage('archive'):
+        for fname in fnames:
+            try:
+                with metrics.file(fname) as rec:
+                    if fname.lower().endswith(ARCHIVE_EXT):
+                        outfname = decode(fname, force=force)
+                    else:
+                        outfname = encode(fname)
+                        if verify:
+                            with open(fname, 'rb') as f:
+                                original = f.read()
+                            if ''.join(line + '\n' for line in iter_lines(outfname)).rstrip('\n') != original.replace('\r\n', '\n').rstrip('\n'):
+                                raise ValueError('Round trip of %s failed!' % fname)
+                    rec.bytes_written = os.path.getsize(outfname)
+            except ValueError as e:
+                print >> sys.stderr, 'ERROR: %s' % e
+                failures += 1
+                continue
+            if outfname.endswith(ARCHIVE_EXT):
+                print '%s -> %s  (%.1f%% of original size)' % (fname, outfname, 100.0 * rec.bytes_written / max(rec.bytes_read, 1))
+            else:
+                print '%s -> %s' % (fname, outfname)
+    return failures
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Encode combined cave site files as compact archives, or decode them back')
+    parser.add_argument('fnames', metavar='FILE', nargs='*', help='CAVE_site.csv files to encode or CAVE_site.hca files to decode (default: all .csv)')
+    parser.add_argument('--verify', action='store_true', help='check that encoded files decode to the original')
+    parser.add_argument('--force', action='store_true', help='overwrite existing CSV files when decoding')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    failures = hobo_metrics.run(args, main, args.fnames, args.verify, args.force)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Benchmark our cave data processing scripts against a synthetic archive.
+
+A realistic HOBO archive is generated offline (see `hobo_synthetic.py`)
+within a scratch directory, then each stage of the processing workflow is
+timed in turn, in the order we run them for real:
+
+    status     hobo_check_status.py
+    hash       hobo_check_status.py --hash, with a cold scan cache
+    truncate   hobo_truncate_bad_files.py
+    combine    hobo_combine_all.py
+    anomaly    hobo_anomaly.py
+    matrix     hobo_matrix.py
+    climatology hobo_climatology.py, rebuilding its daily cache from scratch
+    freeze     hobo_freeze.py
+    psychro    hobo_psychro.py, adding derived columns to the combined files
+    summary    hobo_summary_spreadsheet.py
+    plot       hobo_plot.py, re-using one figure template for all sites as batch runs do
+    plot_each  hobo_plot.py, building a new figure for every site (for comparison with `plot`)
+
+Both plot stages import their dependencies before timing starts, and
+report the time per figure as `plot/file` and `plot_each/file`.
+    ice        ice_process.py  (without GDAL grid generation)
+    startup    `--help` invocation of every script, as run from shell loops
+
+Results are written as JSON so that runs may be compared for regressions.
+
+hobo_benchmark.py [-y YEARS] [-c CAVES] [-i MINUTES] [-o RESULTS.json]
+    Run the benchmark suite
+
+hobo_benchmark.py --compare BASELINE.json [...]
+    Run the benchmark suite and compare against an earlier run
+"""
+
+import sys, os, os.path
+import json
+import subprocess
+import shutil
+import tempfile
+import platform
+from glob import glob
+from time import time
+from datetime import datetime
+from contextlib import contextmanager
+
+import hobo_synthetic
+
+
+STAGES = ['status', 'hash', 'truncate', 'combine', 'anomaly', 'matrix', 'climatology', 'freeze', 'psychro', 'summary', 'plot', 'plot_each', 'ice', 'startup']
+SCRIPTS = ['hobo_check_status.py', 'hobo_truncate_bad_files.py', 'hobo_combine_all.py', 'hobo_anomaly.py',
+           'hobo_matrix.py', 'hobo_climatology.py', 'hobo_freeze.py', 'hobo_psychro.py',
+           'hobo_summary_spreadsheet.py', 'hobo_plot.py', 'ice_process.py']
+STARTUP_RUNS = 5  # invocations of each script per startup benchmark
+REGRESSION_THRESHOLD = 0.10  # fractional slowdown which we consider a regression
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))  # resolved now, as stages run within the archive
+
+
+@contextmanager
+def quiet():
+    """Silence the chatty stdout of our processing scripts"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+@contextmanager
+def working_dir(d):
+    """Our scripts expect to be run from within the archive directory"""
+    cwd = os.getcwd()
+    os.chdir(d)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def bench_status(workdir):
+    import hobo_check_status
+    hobo_check_status.main('.', None)
+
+def bench_hash(workdir):
+    import hobo_check_status
+    hobo_check_status.hash_main('.', None)
+
+def bench_truncate(workdir):
+    import hobo_truncate_bad_files
+    for fname in sorted(hobo_truncate_bad_files.rglob('.', '*.csv')):
+        hobo_truncate_bad_files.copy(fname)
+
+def bench_combine(workdir):
+    import hobo_combine_all
+    hobo_combine_all.main('.', workdir, None)
+
+def bench_anomaly(workdir):
+    import hobo_anomaly
+    from hobo_combine_all import is_site_fname
+    hobo_anomaly.main(sorted(filter(is_site_fname, glob(os.path.join(workdir, '*_*.csv')))))
+
+def bench_matrix(workdir):
+    import hobo_matrix
+    from hobo_combine_all import is_site_fname
+    hobo_matrix.main(sorted(filter(is_site_fname, glob(os.path.join(workdir, '*_*.csv')))),
+                     os.path.join(workdir, hobo_matrix.MATRIX_DIR))
+
+def bench_climatology(workdir):
+    import hobo_climatology
+    from hobo_combine_all import is_site_fname
+    hobo_climatology.main(sorted(filter(is_site_fname, glob(os.path.join(workdir, '*_*.csv')))),
+                          os.path.join(workdir, hobo_climatology.CACHE_DIR), rebuild=True)
+
+def bench_freeze(workdir):
+    import hobo_freeze
+    from hobo_combine_all import is_site_fname
+    hobo_freeze.main(sorted(filter(is_site_fname, glob(os.path.join(workdir, '*_*.csv')))), workdir)
+
+def bench_psychro(workdir):
+    import hobo_psychro
+    from hobo_combine_all import is_site_fname
+    hobo_psychro.main(sorted(filter(is_site_fname, glob(os.path.join(workdir, '*_*.csv')))))
+
+def bench_summary(workdir):
+    import hobo_summary_spreadsheet
+    hobo_summary_spreadsheet.csv_main('.', os.path.join(workdir, 'summary.csv'))
+
+def warm_plot(workdir):
+    import matplotlib
+    matplotlib.use('Agg')
+    import hobo_plot
+    hobo_plot._import_dependencies()
+
+warm_plot_each = warm_plot
+
+def _plot_all(workdir, reuse):
+    import hobo_plot
+    from hobo_combine_all import is_site_fname
+    fnames = sorted(filter(is_site_fname, glob(os.path.join(workdir, '*_*.csv'))))
+    template = hobo_plot.PlotTemplate() if reuse else None
+    for fname in fnames:
+        hobo_plot.hobo_plot(fname, template=template)
+    if template:
+        template.close()
+    return len(fnames)
+
+def bench_plot(workdir):
+    return _plot_all(workdir, reuse=True)
+
+def bench_plot_each(workdir):
+    return _plot_all(workdir, reuse=False)
+
+def bench_ice(workdir):
+    import ice_process
+    ice_process.process(os.path.join(workdir, 'ice_survey.xlsx'), grid=False)
+
+
+def bench_startup(workdir):
+    with open(os.devnull, 'w') as devnull:
+        for script in SCRIPTS:
+            for i in range(STARTUP_RUNS):
+                subprocess.check_call([sys.executable, os.path.join(SCRIPT_DIR, script), '--help'], stdout=devnull)
+
+
+def run_once(config, stages, keep=False):
+    """
+    Generate a fresh archive, time each stage, and return {stage: seconds}.
+
+    A stage's `warm_` function, if any, runs untimed beforehand (eg. to
+    import dependencies which only one stage would otherwise pay for).
+    Stages which return a count of files processed are also timed per file.
+    """
+    archive = tempfile.mkdtemp(prefix='hobo_bench_')
+    workdir = os.path.join(archive, '_Final Analysis')
+    os.mkdir(workdir)
+    timings = {}
+    try:
+        tstart = time()
+        hobo_synthetic.generate_archive(archive, config['years'], config['caves'], config['sites'],
+                                        config['interval'], seed=config['seed'])
+        hobo_synthetic.generate_ice_workbook(os.path.join(workdir, 'ice_survey.xlsx'),
+                                             rooms=config['ice_rooms'], points=config['ice_points'], seed=config['seed'])
+        timings['generate'] = time() - tstart
+
+        with working_dir(archive):
+            for stage in stages:
+                bench, warm = globals()['bench_' + stage], globals().get('warm_' + stage)
+                with quiet():
+                    if warm:
+                        warm(workdir)
+                    tstart = time()
+                    count = bench(workdir)
+                    timings[stage] = time() - tstart
+                if count:
+                    timings[stage + '/file'] = timings[stage] / count
+                    print '  %-12s %8.3fs  (%.3fs per file)' % (stage, timings[stage], timings[stage + '/file'])
+                else:
+                    print '  %-12s %8.3fs' % (stage, timings[stage])
+    finally:
+        if keep:
+            print 'Kept benchmark archive', archive
+        else:
+            shutil.rmtree(archive, ignore_errors=True)
+    return timings
+
+
+def run(config, stages, repeat=1, keep=False):
+    """Run the benchmark suite `repeat` times, produce results dict"""
+    runs = []
+    for i in range(repeat):
+        print 'Run %d of %d ...' % (i + 1, repeat)
+        runs.append(run_once(config, stages, keep))
+    results = {}
+    for stage in runs[0]:
+        times = [r[stage] for r in runs]
+        results[stage] = {'best': min(times), 'mean': sum(times) / len(times), 'runs': times}
+    return {
+        'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """Print a comparison of two benchmark results, return list of regressed stages"""
+    regressions = []
+    if baseline.get('config') != current.get('config'):
+        print 'WARNING: benchmark configurations differ, comparison may not be meaningful'
+    print '\n%-12s %10s %10s %8s' % ('STAGE', 'BASELINE', 'CURRENT', 'CHANGE')
+    for stage, result in sorted(current['results'].items()):
+        if stage not in baseline['results']:
+            continue
+        before, after = baseline['results'][stage]['best'], result['best']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if stage != 'generate' and change > threshold:
+            regressions.append(stage)
+            flag = '  REGRESSION'
+        print '%-12s %9.3fs %9.3fs %+7.1f%%%s' % (stage, before, after, change * 100, flag)
+    return regressions
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark cave data processing against a synthetic archive')
+    parser.add_argument('-y', '--years', type=int, default=hobo_synthetic.DEFAULT_YEARS, help='number of field seasons')
+    parser.add_argument('-c', '--caves', default=','.join(hobo_synthetic.DEFAULT_CAVES), help='comma-separated cave list')
+    parser.add_argument('-s', '--sites', default=','.join(hobo_synthetic.DEFAULT_SITES), help='comma-separated site list')
+    parser.add_argument('-i', '--interval', type=int, default=hobo_synthetic.DEFAULT_INTERVAL, help='sample interval in minutes')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated list of stages to run')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='number of times to repeat the suite')
+    parser.add_argument('-o', '--output', help='write JSON results to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against earlier JSON results')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='fractional slowdown considered a regression')
+    parser.add_argument('--keep', action='store_true', help='keep the generated archive for inspection')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage: %s' % stage)
+
+    config = {
+        'years': args.years,
+        'caves': args.caves.split(','),
+        'sites': args.sites.split(','),
+        'interval': args.interval,
+        'seed': args.seed,
+        'ice_rooms': 3,
+        'ice_points': 200,
+    }
+    results = run(config, stages, args.repeat, args.keep)
+
+    if args.output:
+        with open(args.output, 'w') as outf:
+            json.dump(results, outf, indent=2, sort_keys=True)
+        print 'Wrote benchmark results to', args.output
+
+    if args.compare:
+        with open(args.compare, 'r') as inf:
+            baseline = json.load(inf)
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
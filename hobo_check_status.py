@@ -9,10 +9,30 @@ usage:
     check_hobo_status.py CAVE...
         Check the status of the specified caves
 
+    check_hobo_status.py --hash [-j JOBS] [CAVE...]
+        Also check file contents: hash every HOBO and CSV file to find
+        duplicates exported under different names, compare each CSV's
+        logger serial number with its filename, flag empty or truncated
+        CSV files, and report each season's coverage per cave site.
+        Hashes and CSV details are cached in `.hobo_status_cache.json`,
+        keyed on file size and modification time, so that repeat runs only
+        read new or changed files.
+
 2016-02-19  David A. Riggs, Physical Science Tech
 """
 
 import sys, os, os.path
+import json
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+
+CACHE_FNAME = '.hobo_status_cache.json'
+HASH_BLOCK = 1024 * 1024
+TAIL_BYTES = 4096
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+TZ = -8  # as `hobo_combine_all.py`
 
 
 def find_dirs(rootdir):
@@ -59,7 +79,7 @@ def get_files(d, sites=None, exts=None):
     return l
 
 
-def main(rootdir, sites):
+def main(rootdir, sites, check_contents=False, jobs=1):
     for year, hobodir, csvdir in find_dirs(rootdir):
         hobofiles = get_files(hobodir, sites, ['.hobo', '.hproj'])
         csvfiles = get_files(csvdir, sites, '.csv')
@@ -80,8 +100,244 @@ def main(rootdir, sites):
             for f in sorted(diff2):
                 print '\t\t', f
 
+    if check_contents:
+        hash_main(rootdir, sites, jobs)
+
+
+def _csv_fields(line):
+    import csv
+    line = line.rstrip('\r')
+    return next(csv.reader([line])) if line.strip() else []
+
+def _csv_details(head, tail, complete):
+    """
+    Logger serial number, first and last timestamps, and problems of a
+    HOBOware CSV file, from just its first and last few KB.
+    """
+    import hobo
+    details = {'sn': '', 'first': '', 'last': '', 'problems': []}
+    lines = head.split('\n')
+    if len(lines) < 3:
+        details['problems'].append('empty' if not head.strip() else 'no data')
+        return details
+    header = lines[1]
+    sn = hobo.SN_REGEX.findall(header)
+    tz = hobo.TZ_REGEX.search(header)
+    headers = _csv_fields(header)
+    its = [i for i, h in enumerate(headers) if 'Date Time' in h]
+    itemp = [i for i, h in enumerate(headers) if 'Temp,' in h or 'High Res. Temp.' in h]
+    if not (tz and its and itemp):
+        details['problems'].append('unrecognized header')
+        return details
+    details['sn'] = sn[0] if sn else ''
+    its, itemp = its[0], itemp[0]
+    tz, as_tz = hobo.TZFixedOffset(tz.group()), hobo.TZFixedOffset(TZ)
+
+    def timestamp(line):
+        fields = _csv_fields(line)
+        if len(fields) <= max(its, itemp) or not fields[0].strip().isdigit() or not fields[itemp]:
+            return None  # blank, header, or event-only row
+        return hobo.timestamp(fields[its], tz).astimezone(as_tz).strftime(TIME_FMT)
+
+    tail_lines = tail.split('\n')
+    if complete:
+        tail_lines = tail_lines[:-1]  # the empty string after the final newline
+    elif tail_lines:
+        last_fields = _csv_fields(tail_lines[-1])
+        if len(last_fields) < len(headers):
+            details['problems'].append('truncated')
+        tail_lines = tail_lines[:-1]
+    try:
+        details['first'] = next((t for t in (timestamp(l) for l in lines[2:-1]) if t), '')
+        details['last'] = next((t for t in (timestamp(l) for l in reversed(tail_lines[1:])) if t), '')
+    except ValueError as e:
+        details['problems'].append('bad timestamp (%s)' % e)
+    if not details['first']:
+        details['problems'].append('no data')
+    return details
+
+
+def scan_file(fname):
+    """
+    Hash a file's contents, and for CSV files also the data after the
+    two-line HOBOware header (so re-exports with a different title still
+    match), and read its details from just the first and last few KB.
+    """
+    import hashlib
+    digest, data_digest = hashlib.sha1(), hashlib.sha1()
+    head, lines, header_left = '', 0, 2
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+            if not head:
+                head = block[:TAIL_BYTES]
+            lines += block.count('\n')
+            while header_left and block:
+                newline = block.find('\n')
+                block = block[newline + 1:] if newline >= 0 else ''
+                header_left -= newline >= 0
+            data_digest.update(block)
+        size = f.tell()
+        f.seek(max(0, size - TAIL_BYTES))
+        tail = f.read()
+
+    st = os.stat(fname)
+    result = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': digest.hexdigest()}
+    if fname.lower().endswith('.csv'):
+        result['data_sha1'] = data_digest.hexdigest()
+        result['rows'] = max(0, lines - 2)
+        result.update(_csv_details(head, tail, tail.endswith('\n')))
+    return result
+
+def _scan(fname):
+    """Pool worker: returns (fname, scan result, metrics records)"""
+    with metrics.collect() as records:
+        with metrics.file(fname) as rec:
+            result = scan_file(fname)
+            rec.rows = result.get('rows', 0)
+    return fname, result, records
+
+
+class ScanCache(object):
+    """Persistent file scan results, valid while a file's size and modification time are unchanged"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.files = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                self.files = json.load(f)
+
+    def get(self, fname):
+        entry = self.files.get(fname)
+        if entry is None:
+            return None
+        st = os.stat(fname)
+        return entry if (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime) else None
+
+    def put(self, fname, result):
+        self.files[fname] = result
+
+    def save(self):
+        with open(self.fname, 'w') as f:
+            json.dump(self.files, f, indent=0, sort_keys=True)
+
+
+def scan_all(fnames, cache, jobs=1):
+    """Scan results for all files, scanning (in parallel) only those not validly cached"""
+    results = {}
+    stale = []
+    for fname in fnames:
+        entry = cache.get(fname)
+        if entry is None:
+            stale.append(fname)
+        else:
+            results[fname] = entry
+    print '%d files, %d cached, %d to scan ...' % (len(fnames), len(results), len(stale))
+    if jobs > 1 and len(stale) > 1:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        scanned = pool.imap_unordered(_scan, stale)
+    else:
+        pool = None
+        scanned = (_scan(fname) for fname in stale)
+    for fname, result, records in scanned:
+        if pool is not None:
+            metrics.merge(records)
+        results[fname] = result
+        cache.put(fname, result)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    # forget files which no longer exist, but keep those merely outside this run's site filter
+    cache.files = dict((fname, entry) for fname, entry in cache.files.items() if os.path.exists(fname))
+    cache.save()
+    return results
+
+
+def _serial(fname):
+    """Logger serial number from a `CAVE_site_SERIAL[_cropped].ext` filename"""
+    toks = os.path.splitext(os.path.basename(fname))[0].replace('_cropped', '').split('_')
+    return toks[2] if len(toks) > 2 else ''
+
+
+def _days(first, last):
+    from datetime import datetime
+    delta = datetime.strptime(last, TIME_FMT) - datetime.strptime(first, TIME_FMT)
+    return delta.days + delta.seconds / 86400.0
+
+
+def hash_main(rootdir, sites, jobs=1):
+    """Check file contents: duplicates, serial number mismatches, empty or truncated files, and coverage"""
+    seasons = []
+    for year, hobodir, csvdir in find_dirs(rootdir):
+        hobofiles = [os.path.join(hobodir, f) for f in get_files(hobodir, sites, ['.hobo', '.hproj'])] if hobodir else []
+        csvfiles = [os.path.join(csvdir, f) for f in get_files(csvdir, sites, '.csv')] if csvdir else []
+        seasons.append((year, sorted(hobofiles), sorted(csvfiles)))
+
+    with metrics.stage('hash'):
+        cache = ScanCache(os.path.join(rootdir, CACHE_FNAME))
+        results = scan_all([f for year, hobofiles, csvfiles in seasons for f in hobofiles + csvfiles], cache, jobs)
+
+    previous_last = {}  # CAVE_site -> last timestamp of its latest deployment so far
+    for year, hobofiles, csvfiles in sorted(seasons):
+        print '\n%d has %d HOBO files, %d CSV files ...' % (year, len(hobofiles), len(csvfiles))
+        hobo_serials = set(_serial(f) for f in hobofiles)
+
+        problems = []
+        for fname in csvfiles:
+            r = results[fname]
+            basename = os.path.basename(fname)
+            for problem in r['problems']:
+                problems.append('%s: %s' % (basename, problem))
+            if r['sn'] and r['sn'] != _serial(fname):
+                problems.append('%s: logger S/N %s does not match filename' % (basename, r['sn']))
+            if r['sn'] and r['sn'] not in hobo_serials:
+                problems.append('%s: no HOBO file for logger S/N %s' % (basename, r['sn']))
+        if problems:
+            print '\t%d problems:' % len(problems)
+            for problem in problems:
+                print '\t\t', problem
+
+        print '\tcoverage:'
+        deployed = [('_'.join(os.path.basename(fname).split('_')[:2]), results[fname]['first'], fname)
+                    for fname in csvfiles if results[fname]['first'] and results[fname]['last']]
+        for key, first, fname in sorted(deployed):  # each site's deployments in time order
+            r = results[fname]
+            gap = ''
+            if key in previous_last:
+                gap_days = _days(previous_last[key], r['first'])
+                gap = ('  gap %.1f days' % gap_days) if gap_days > 1 else ('  overlap %.1f days' % -gap_days) if gap_days < 0 else ''
+            previous_last[key] = max(previous_last.get(key, ''), r['last'])
+            print '\t\t%-16s %s .. %s %6.1f days %7d rows%s' % (
+                key, r['first'], r['last'], _days(r['first'], r['last']), r['rows'], gap)
+
+    by_hash = {}
+    for fname, r in results.items():
+        if r['size'] == 0 or r.get('rows') == 0 or set(r.get('problems', [])) & {'empty', 'no data'}:
+            continue  # already reported, and all empty files would "match"
+        by_hash.setdefault(r.get('data_sha1') or r['sha1'], []).append(fname)
+    duplicates = sorted(sorted(fnames) for fnames in by_hash.values() if len(fnames) > 1)
+    if duplicates:
+        print '\n%d sets of duplicate files:' % len(duplicates)
+        for fnames in duplicates:
+            print '\t' + '\n\t\t'.join(os.path.relpath(f, rootdir) for f in fnames)
+    else:
+        print '\nNo duplicate files.'
+
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Check whether HOBO data logger files have been exported as CSV')
+    parser.add_argument('sites', metavar='CAVE', nargs='*', help='caves to check (default: all)')
+    parser.add_argument('--hash', action='store_true', help='also check file contents (duplicates, serial numbers, truncation, coverage)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of files to hash in parallel')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
     rootdir = '.'
-    sites = sys.argv[1:] if len(sys.argv) > 1 else None
-    main(rootdir, sites)
+    sites = args.sites or None
+    hobo_metrics.run(args, main, rootdir, sites, args.hash, args.jobs)
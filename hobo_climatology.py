@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+Day-of-year climatology normals, and anomaly series, for combined cave site files.
+
+For each cave site, the combined series is reduced to daily aggregates,
+and the daily means of every season are pooled by day of year to give the
+site's "normal" for each day: the mean, standard deviation, and
+percentiles of all daily means within `WINDOW` days of that day of year,
+across every year of data. Normals for all sites are computed together, in
+one vectorized grouped pass. Results are written alongside each combined
+file:
+
+    CAVE_site_normals.csv   VARIABLE, DOY, YEARS, COUNT, MEAN, STDDEV, P10 ... P90
+    CAVE_site_anomaly.csv   daily mean, normal, and anomaly (departure from normal)
+
+Reducing a year-long 1-minute series to daily aggregates is the expensive
+part, so the daily aggregates are cached in `climatology/`. Combined files
+are sorted by time, so when a new season is combined onto the end of a
+file, only the newly appended records are read and merged into the cache.
+If a file has otherwise changed, its cache is rebuilt from scratch.
+
+hobo_climatology.py
+    Update climatology for all combined CAVE_site.csv files in the current directory
+
+hobo_climatology.py CAVE_site.csv...
+    Update climatology for just the specified files
+"""
+
+import os, os.path
+import json
+from StringIO import StringIO
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+
+CACHE_DIR = 'climatology'
+CACHE_STATE = 'cache.json'
+VARIABLES = ['Temperature', 'RH']
+AGGREGATES = ['sum', 'count', 'min', 'max']
+PERCENTILES = [10, 25, 50, 75, 90]
+WINDOW = 7            # pool daily means within this many days either side of each day of year
+MIN_DAY_FRACTION = 0.5  # a day's mean needs at least this fraction of a typical day's samples
+
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+DATE_FMT = '%Y-%m-%d'
+NORMAL_COLUMNS = ['VARIABLE', 'DOY', 'YEARS', 'COUNT', 'MEAN', 'STDDEV'] + ['P%d' % p for p in PERCENTILES]
+
+
+def normals_fname(fname):
+    """Normals sidecar filename for a combined cave site file"""
+    return os.path.splitext(fname)[0] + '_normals.csv'
+
+def anomaly_fname(fname):
+    """Anomaly series sidecar filename for a combined cave site file"""
+    return os.path.splitext(fname)[0] + '_anomaly.csv'
+
+def site_key(fname):
+    return os.path.splitext(os.path.basename(fname))[0]
+
+
+def day_of_year(index):
+    """
+    Day of year (1-365) of each timestamp, on a non-leap calendar so that
+    the same date always has the same day of year; Feb 29 shares Feb 28's.
+    """
+    import numpy as np
+    doy = np.asarray(index.dayofyear)
+    return doy - (np.asarray(index.is_leap_year) & (doy >= 60))
+
+
+def read_daily(fname, offset=0):
+    """
+    Daily aggregates of the records of a sorted combined file, starting at
+    byte `offset` (which must be the start of a line).
+
+    :return: (daily DataFrame indexed by date, offset just past the last complete line read)
+    """
+    import pandas as pd
+    with open(fname, 'rb') as f:
+        header = f.readline()
+        if not header.endswith('\n'):
+            return empty_daily(), offset
+        columns = header.rstrip('\r\n').split(',')  # the file's own header, which may include derived columns
+        start = max(offset, f.tell())
+        f.seek(start)
+        data = f.read()
+    data = data[:data.rfind('\n') + 1]  # never consume a partially written line
+    end = start + len(data)
+    if not data.strip():
+        return empty_daily(), end
+
+    missing = [col for col in ['DateTime'] + VARIABLES if col not in columns]
+    if missing:
+        raise ValueError('%s has no %s column' % (fname, ', '.join(missing)))
+    usecols = [columns.index(col) for col in ['DateTime'] + VARIABLES]
+    frame = pd.read_csv(StringIO(data), header=None, usecols=usecols)
+    frame.columns = [columns[i] for i in usecols]
+    frame.index = pd.to_datetime(frame.pop('DateTime'), format=TIME_FMT)
+    daily = frame.groupby(frame.index.floor('D')).agg(AGGREGATES)
+    daily.columns = ['%s_%s' % col for col in daily.columns]
+    daily.index.name = 'DATE'
+    return daily, end
+
+def empty_daily():
+    import pandas as pd
+    daily = pd.DataFrame(columns=['%s_%s' % (var, agg) for var in VARIABLES for agg in AGGREGATES], dtype=float)
+    daily.index = pd.DatetimeIndex([], name='DATE')
+    return daily
+
+def merge_daily(old, new):
+    """Combine two sets of daily aggregates, eg. where both include part of the same day"""
+    import pandas as pd
+    if not len(old):
+        return new
+    rules = dict((col, col.rsplit('_', 1)[1].replace('count', 'sum')) for col in new.columns)
+    return pd.concat([old, new]).groupby(level=0).agg(rules)[new.columns]
+
+
+class DailyCache(object):
+    """
+    Cached daily aggregates of each combined file, with enough state to
+    tell whether a file has only had records appended since it was cached.
+    """
+
+    def __init__(self, dirname=CACHE_DIR):
+        self.dirname = dirname
+        self.state_fname = os.path.join(dirname, CACHE_STATE)
+        self.state = {}
+        if os.path.exists(self.state_fname):
+            with open(self.state_fname) as f:
+                self.state = json.load(f)
+
+    def daily_fname(self, fname):
+        return os.path.join(self.dirname, site_key(fname) + '_daily.csv')
+
+    def _appended(self, fname, entry):
+        """Does the file still begin with everything we cached, ie. have records only been appended?"""
+        size = os.path.getsize(fname)
+        if size < entry['offset'] or not os.path.exists(self.daily_fname(fname)):
+            return False
+        with open(fname, 'rb') as f:
+            head = f.read(len(entry['head']))
+            f.seek(entry['offset'] - len(entry['tail']))
+            tail = f.read(len(entry['tail']))
+        return head == entry['head'] and tail == entry['tail']
+
+    def update(self, fname, rebuild=False):
+        """
+        Bring a file's cached daily aggregates up to date.
+
+        :return: (daily DataFrame, how it was updated: "cached", "appended", or "rebuilt")
+        """
+        st = os.stat(fname)
+        key = site_key(fname)
+        entry = self.state.get(key) if not rebuild else None
+        if entry and [st.st_size, st.st_mtime] == entry['stat'] and os.path.exists(self.daily_fname(fname)):
+            return self.load(fname), 'cached'
+
+        with metrics.file(fname) as rec:
+            if entry and self._appended(fname, entry):
+                how, old, offset = 'appended', self.load(fname), entry['offset']
+            else:
+                how, old, offset = 'rebuilt', empty_daily(), 0
+            new, end = read_daily(fname, offset)
+            daily = merge_daily(old, new)
+            rec.bytes_read = end - offset
+            rec.rows = int(new[VARIABLES[0] + '_count'].sum()) if len(new) else 0
+
+        with open(fname, 'rb') as f:
+            head = f.read(4096).split('\n', 2)
+            f.seek(max(0, end - 4096))
+            tail = f.read(end - f.tell()).rstrip('\n').rsplit('\n', 1)[-1] + '\n'
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+        daily.to_csv(self.daily_fname(fname), date_format=DATE_FMT)
+        self.state[key] = {
+            'stat': [st.st_size, st.st_mtime],
+            'offset': end,
+            'head': '\n'.join(head[:2]) + '\n' if len(head) > 2 else '',
+            'tail': tail if end else '',
+        }
+        return daily, how
+
+    def load(self, fname):
+        import pandas as pd
+        return pd.read_csv(self.daily_fname(fname), index_col='DATE', parse_dates=['DATE'])
+
+    def save(self):
+        with open(self.state_fname, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+
+
+def daily_means(daily):
+    """Daily means of each variable, NaN for days without enough samples to be representative"""
+    import numpy as np
+    import pandas as pd
+    means = {}
+    for var in VARIABLES:
+        counts = daily[var + '_count'].values.astype(float)
+        typical = np.median(counts[counts > 0]) if (counts > 0).any() else 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[var] = np.where(counts >= MIN_DAY_FRACTION * typical, daily[var + '_sum'].values / counts, np.nan)
+    return pd.DataFrame(means, index=daily.index, columns=VARIABLES)
+
+
+def _group_percentiles(groups, values, percentiles):
+    """
+    Percentiles (linearly interpolated, as `numpy.percentile`) of `values`
+    within each group, for all groups at once.
+
+    :param groups:  non-negative integer group ID per value
+    :return: (sorted unique group IDs, array of group x percentile)
+    """
+    import numpy as np
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    ids, starts, counts = np.unique(groups, return_index=True, return_counts=True)
+    pos = starts[:, None] + (counts[:, None] - 1) * (np.asarray(percentiles, dtype=float)[None, :] / 100.0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, (starts + counts - 1)[:, None])
+    return ids, values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def compute_normals(means_by_site, window=WINDOW):
+    """
+    Day-of-year normals for many sites at once.
+
+    Every daily mean is replicated to each day of year within `window` days
+    of its own (wrapping around the new year), then all (site, variable,
+    day of year) groups are reduced together.
+
+    :param means_by_site:  {CAVE_site: DataFrame of daily means}, see `daily_means()`
+    :return: {CAVE_site: normals DataFrame with `NORMAL_COLUMNS`}
+    """
+    import numpy as np
+    import pandas as pd
+
+    sites = sorted(means_by_site)
+    site_ids, var_ids, doys, years, values = [], [], [], [], []
+    for s, site in enumerate(sites):
+        means = means_by_site[site]
+        doy, year = day_of_year(means.index), np.asarray(means.index.year)
+        for v, var in enumerate(VARIABLES):
+            vals = means[var].values
+            valid = ~np.isnan(vals)
+            n = valid.sum()
+            site_ids.append(np.full(n, s, dtype=np.int64))
+            var_ids.append(np.full(n, v, dtype=np.int64))
+            doys.append(doy[valid])
+            years.append(year[valid])
+            values.append(vals[valid])
+    if not sites or not sum(len(v) for v in values):
+        return dict((site, pd.DataFrame(columns=NORMAL_COLUMNS)) for site in sites)
+    site_ids, var_ids, doys, years, values = [np.concatenate(a) for a in (site_ids, var_ids, doys, years, values)]
+
+    # pool each value into the neighboring days of year
+    offsets = np.arange(-window, window + 1)
+    pooled_doy = (doys[:, None] - 1 + offsets[None, :]) % 365 + 1
+    reps = len(offsets)
+    groups = ((np.repeat(site_ids, reps) * len(VARIABLES) + np.repeat(var_ids, reps)) * 366 + pooled_doy.ravel())
+    values, years = np.repeat(values, reps), np.repeat(years, reps)
+
+    ids, pcts = _group_percentiles(groups, values, PERCENTILES)
+    stats = pd.DataFrame({'value': values, 'group': groups}).groupby('group')['value'].agg(['count', 'mean', 'std'])
+    nyears = pd.DataFrame({'group': groups, 'year': years}).drop_duplicates().groupby('group').size()
+
+    normals = pd.DataFrame(pcts, columns=['P%d' % p for p in PERCENTILES])
+    normals['SITE'] = ids // (len(VARIABLES) * 366)
+    normals['VARIABLE'] = np.array(VARIABLES)[ids // 366 % len(VARIABLES)]
+    normals['DOY'] = ids % 366
+    normals['YEARS'] = nyears.reindex(ids).values
+    normals['COUNT'] = stats['count'].reindex(ids).values
+    normals['MEAN'] = stats['mean'].reindex(ids).values
+    normals['STDDEV'] = stats['std'].reindex(ids).fillna(0).values
+
+    by_site = dict((sites[s], group[NORMAL_COLUMNS].reset_index(drop=True)) for s, group in normals.groupby('SITE'))
+    return dict((site, by_site.get(site, pd.DataFrame(columns=NORMAL_COLUMNS))) for site in sites)
+
+
+def write_normals(fname, normals):
+    normals.to_csv(fname, index=False, float_format='%.3f')
+
+def load_normals(fname):
+    """Load a normals CSV into a DataFrame, or `None` if it doesn't exist"""
+    import pandas as pd
+    if not os.path.exists(fname):
+        return None
+    return pd.read_csv(fname)
+
+def normal_for(normals, var, index, column='MEAN'):
+    """A variable's normal `column` value for each timestamp of a DatetimeIndex"""
+    table = normals[normals['VARIABLE'] == var].set_index('DOY')[column]
+    return table.reindex(day_of_year(index)).values.astype(float)
+
+
+def anomalies(means, normals):
+    """Daily means, their normals, and anomalies (departures from normal) of each variable"""
+    import pandas as pd
+    result = pd.DataFrame(index=means.index)
+    for var in VARIABLES:
+        normal = normal_for(normals, var, means.index)
+        result[var] = means[var].values
+        result[var + '_NORMAL'] = normal
+        result[var + '_ANOMALY'] = means[var].values - normal
+    return result
+
+
+def main(fnames, cachedir=CACHE_DIR, window=WINDOW, rebuild=False):
+    if not fnames:
+        from glob import glob
+        from hobo_combine_all import is_site_fname
+        fnames = sorted(filter(is_site_fname, glob('*.csv')))
+
+    cache = DailyCache(cachedir)
+    means, changed = {}, set()
+    with metrics.stage('daily'):
+        for fname in fnames:
+            daily, how = cache.update(fname, rebuild)
+            means[site_key(fname)] = daily_means(daily)
+            if how != 'cached' or not os.path.exists(normals_fname(fname)):
+                changed.add(fname)
+            print '%-16s %5d days (%s)' % (site_key(fname), len(daily), how)
+        cache.save()
+
+    if not changed:
+        print 'All normals are up to date'
+        return
+    with metrics.stage('normals'):
+        normals = compute_normals(dict((site_key(fname), means[site_key(fname)]) for fname in changed), window)
+        for fname in sorted(changed):
+            site_normals = normals[site_key(fname)]
+            write_normals(normals_fname(fname), site_normals)
+            anomalies(means[site_key(fname)], site_normals).to_csv(
+                anomaly_fname(fname), index_label='DATE', date_format=DATE_FMT, float_format='%.3f')
+            print 'Wrote', normals_fname(fname), 'and', anomaly_fname(fname)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Compute day-of-year climatology normals and anomaly series for combined cave site files')
+    parser.add_argument('fnames', metavar='CAVE_site.csv', nargs='*', help='combined files to process (default: all)')
+    parser.add_argument('-c', '--cachedir', default=CACHE_DIR, help='daily aggregate cache directory (default: %(default)s)')
+    parser.add_argument('-w', '--window', type=int, default=WINDOW, help='pool days within this many days of each day of year (default: %(default)s)')
+    parser.add_argument('--rebuild', action='store_true', help='ignore the cache and re-read every file in full')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.fnames, args.cachedir, args.window, args.rebuild)
@@ -3,6 +3,10 @@
 Combines all HOBO data logger CSV files into a single, sorted, and
 timezone-normalized CSV file into the current directory.
 
+Duplicate records are dropped (see `hobo_coverage.py` for policies), and a
+`CAVE_site_coverage.csv` index of deployments, gaps, and overlaps is
+written alongside each combined file.
+
 hobo_combine_all.py
     Combine HOBO data logger files for all caves in the default list
 
@@ -17,6 +21,10 @@ import fnmatch
 
 from hobo import HoboCSVReader
 
+from hobo_metrics import metrics
+import hobo_metrics
+import hobo_coverage
+
 
 # TODO: clean these hard-coded lists up
 I_AND_M_SITES = set(['BALC','BOUL','CAST','FERN','FOST','GODO','HOCH','JUHE',
@@ -53,49 +61,97 @@ def split_fname(fname):
     season = int([t for t in fname.split(os.sep) if '20' in t][0].split()[0])  # yuck!
     return season, cave, site, basename
 
-def sort_file(fname):
-    """Sort all the records in a .CSV file"""
+def is_site_fname(fname):
+    """Is this the filename of a combined `CAVE_site.csv` file (rather than a raw file or sidecar)?"""
+    stem, ext = os.path.splitext(os.path.basename(fname))
+    return ext.lower() == '.csv' and len(stem.split('_')) == 2
+
+def relabel_file_start(line, file_start):
+    """Replace the FileStart (final) field of a combined CSV line"""
+    return line.rstrip('\r\n').rsplit(',', 1)[0] + ',' + file_start + '\n'
+
+def sort_file(fname, dedup=hobo_coverage.DEFAULT_DEDUP):
+    """
+    Sort all the records in a .CSV file, dropping duplicate records according
+    to the `dedup` policy, and write its coverage index alongside it.
+    """
     # WARNING: This reads and sorts the entire file in memory at once
     print 'Sorting', fname
-    bakfname = fname+'.BAK'
-    os.rename(fname, bakfname)
-    with open(bakfname, 'rU') as infile:
-        lines = infile.readlines()
-    with open(fname, 'w') as outfile:
-        outfile.write(lines[0])
-        for line in sorted(lines[1:]):
-            outfile.write(line)
-    os.remove(bakfname)
+    with metrics.file(fname) as rec:
+        bakfname = fname+'.BAK'
+        os.rename(fname, bakfname)
+        with open(bakfname, 'rU') as infile:
+            lines = infile.readlines()
+        header, body = lines[0], lines[1:]
+
+        frame = hobo_coverage.read_series(bakfname)
+        if len(frame) != len(body):
+            raise ValueError('Unable to parse all %d rows of %s' % (len(body), fname))
+        keep, coverage = hobo_coverage.analyze(frame, dedup)
+        for i, file_start in hobo_coverage.file_start_markers(frame, keep):
+            body[i] = relabel_file_start(body[i], file_start)
+        body = [body[i] for i in keep.nonzero()[0]]
+        if len(body) < len(lines) - 1:
+            print 'Dropped %d duplicate records' % (len(lines) - 1 - len(body))
+
+        with open(fname, 'w') as outfile:
+            outfile.write(header)
+            for line in sorted(body):
+                outfile.write(line)
+            rec.bytes_written = outfile.tell()
+        rec.rows = len(body)
+        hobo_coverage.write_coverage(hobo_coverage.coverage_fname(fname), coverage)
+        os.remove(bakfname)
 
 
 HEADER = 'DateTime,Year,Month,Day,ISO_Year,ISO_Week,Temperature,RH,Battery,FileStart'
 TZ = -8
 
 
-def main(rootdir, outdir, sites):
-    outfiles = set()
-
-    for fname in find_files(rootdir, sites):
-        if 'Climate' not in fname or 'Excel' not in fname:
-            # we expect the following file structure:  `2017 Season/Climate/Excel Files/*.csv`
-            continue
-        
-        print 'Reading', fname
-        season, cave, site, basename = split_fname(fname)
-        reader = HoboCSVReader(fname, as_timezone=TZ)
-
-        outfname = os.path.join(outdir, '%s_%s.csv' % (cave, site))
-        outfiles.add(outfname)
-        if os.path.exists(outfname):
-            print 'Writing', outfname
-            outf = open(outfname, 'a')
-        else:
-            print 'Creating', outfname
-            outf = open(outfname, 'w')
-            outf.write(HEADER+'\n')
-
+def header(derived=False):
+    """Combined file header, optionally with derived psychrometric columns (see `hobo_psychro.py`)"""
+    if not derived:
+        return HEADER
+    import hobo_psychro
+    return HEADER.replace(',FileStart', ',' + ','.join(hobo_psychro.DERIVED_COLUMNS) + ',FileStart')
+
+
+def combine_file(fname, outdir, derived=False):
+    """
+    Append a single HOBO CSV file to its combined cave site file, return the
+    output filename. With `derived`, psychrometric columns are computed for
+    the whole file at once and written too.
+    """
+    print 'Reading', fname
+    season, cave, site, basename = split_fname(fname)
+    reader = HoboCSVReader(fname, as_timezone=TZ)
+
+    outfname = os.path.join(outdir, '%s_%s.csv' % (cave, site))
+    if os.path.exists(outfname):
+        with open(outfname, 'r') as f:
+            existing = f.readline().rstrip('\r\n')
+        if existing != header(derived):
+            raise ValueError('%s was combined %s derived columns; remove it to re-combine from scratch'
+                             % (outfname, 'without' if derived else 'with'))
+        print 'Writing', outfname
+        outf = open(outfname, 'a')
+    else:
+        print 'Creating', outfname
+        outf = open(outfname, 'w')
+        outf.write(header(derived)+'\n')
+
+    with metrics.file(fname) as rec:
+        outf.seek(0, os.SEEK_END)
+        offset = outf.tell()
         file_start = basename
-        for ts, temp, rh, batt in reader:
+        rows = reader
+        extra = None
+        if derived:
+            import hobo_psychro
+            rows = list(reader)
+            temps, rhs = [row[1] for row in rows], [row[2] for row in rows]
+            extra = zip(*hobo_psychro.format_columns(hobo_psychro.derive(temps, rhs)))
+        for i, (ts, temp, rh, batt) in enumerate(rows):
             iso_year, iso_week, _ = ts.isocalendar()  # ISO 8601 week definition, see: https://www.staff.science.uu.nl/~gent0113/calendar/isocalendar.htm
             outf.write(','.join((
                 ts.strftime('%Y-%m-%d %H:%M:%S'),
@@ -107,20 +163,45 @@ def main(rootdir, outdir, sites):
                 '%.3f' % temp,
                 ('%.3f' % rh) if rh else '',
                 ('%.2f' % batt) if batt else '',
-                file_start
+                ) + (extra[i] if extra else ()) + (
+                file_start,
                 )))
             outf.write('\n')
             file_start = ''
+            rec.rows += 1
+        rec.bytes_written = outf.tell() - offset
+
+    outf.close()
+    print
+    return outfname
+
 
-        outf.close()
-        print
+def main(rootdir, outdir, sites, dedup=hobo_coverage.DEFAULT_DEDUP, derived=False):
+    outfiles = set()
+
+    with metrics.stage('combine'):
+        for fname in find_files(rootdir, sites):
+            if 'Climate' not in fname or 'Excel' not in fname:
+                # we expect the following file structure:  `2017 Season/Climate/Excel Files/*.csv`
+                continue
+            outfiles.add(combine_file(fname, outdir, derived))
 
-    for fname in sorted(outfiles):
-        sort_file(fname)
+    with metrics.stage('sort'):
+        for fname in sorted(outfiles):
+            sort_file(fname, dedup)
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Combine HOBO data logger CSV files into one file per cave site')
+    parser.add_argument('sites', metavar='CAVE', nargs='*', help='caves to combine (default: all)')
+    parser.add_argument('--dedup', choices=hobo_coverage.DEDUP_POLICIES, default=hobo_coverage.DEFAULT_DEDUP,
+                        help='duplicate record policy (default: %(default)s)')
+    parser.add_argument('--derived', action='store_true', help='add derived dew point, absolute humidity, VPD, and Celsius columns')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
     rootdir = '.'
     outdir = '.'
-    sites = sys.argv[1:] if len(sys.argv) > 1 else None
-    main(rootdir, outdir, sites)
+    sites = args.sites or None
+    hobo_metrics.run(args, main, rootdir, outdir, sites, args.dedup, args.derived)
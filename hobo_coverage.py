@@ -0,0 +1,219 @@
+"""
+Deployment coverage analysis and de-duplication for combined cave site series.
+
+Combined `CAVE_site.csv` files are built by appending one data logger file
+(one "deployment") at a time, with the deployment's filename in the
+`FileStart` column of its first row. Before the combined file is sorted, we
+label each row with its deployment and work out, in a single vectorized
+pass over the timestamps:
+
+- the start, end, row count, and sample interval of each deployment
+- gaps in coverage, both between deployments (eg. a late logger swap) and
+  within a deployment (eg. a logger that stopped and restarted)
+- overlaps, where two deployments' records cover the same time
+- changes in sample interval from one deployment to the next
+
+The results are written as a small "coverage index" CSV alongside the
+combined series, `CAVE_site_coverage.csv`, so that plots and summaries can
+use it without re-scanning the raw data.
+
+Duplicate records are dropped according to a policy:
+
+    none    keep every record
+    exact   drop records identical to an earlier one (eg. a file exported twice)
+    first   as `exact`, and where deployments overlap keep the earlier deployment
+    last    as `exact`, and where deployments overlap keep the later deployment
+"""
+
+import os, os.path
+
+
+DEDUP_POLICIES = 'none', 'exact', 'first', 'last'
+DEFAULT_DEDUP = 'exact'
+
+GAP_TOLERANCE = 1.5  # a step longer than this many sample intervals is a gap
+
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+VALUE_COLUMNS = ['Temperature', 'RH', 'Battery']
+COVERAGE_COLUMNS = ['KIND', 'FILE', 'START', 'END', 'DAYS', 'ROWS', 'DROPPED', 'INTERVAL_S', 'DETAIL']
+
+UNKNOWN_DEPLOYMENT = '(unknown)'  # rows appearing before any `FileStart` marker
+
+
+def coverage_fname(fname):
+    """Coverage index filename for a combined cave site file"""
+    return os.path.splitext(fname)[0] + '_coverage.csv'
+
+
+def read_series(fname):
+    """Load the columns of a combined cave site file needed for coverage analysis, in file order"""
+    import pandas as pd
+    frame = pd.read_csv(fname, usecols=['DateTime'] + VALUE_COLUMNS + ['FileStart'],
+                        dtype={'FileStart': object}, skip_blank_lines=False)
+    frame['DateTime'] = pd.to_datetime(frame['DateTime'], format=TIME_FMT)
+    return frame
+
+
+def deployment_ids(frame):
+    """
+    Label each row of an unsorted combined frame with an integer deployment ID.
+    Deployment 0 is reserved for rows before the first `FileStart` marker.
+
+    :return: (ID per row, deployment filename per ID)
+    """
+    import numpy as np
+    marked = frame['FileStart'].notnull().values
+    ids = marked.cumsum()
+    names = np.array([UNKNOWN_DEPLOYMENT] + list(frame['FileStart'].values[marked]), dtype=object)
+    return ids, names
+
+
+def _epoch_seconds(frame):
+    import numpy as np
+    return frame['DateTime'].values.astype('datetime64[s]').astype(np.int64)
+
+
+def dedupe(frame, ids, deployments, policy=DEFAULT_DEDUP):
+    """
+    Determine which rows to keep under a de-duplication policy.
+
+    :param frame:  combined series, in file order
+    :param ids:  deployment ID per row, see `deployment_ids()`
+    :param deployments:  per-deployment DataFrame indexed by ID with `start` and `end` epoch seconds
+    :param str policy:  one of `DEDUP_POLICIES`
+    :return: boolean mask of rows to keep
+    """
+    import numpy as np
+    import pandas as pd
+    if policy not in DEDUP_POLICIES:
+        raise ValueError('Unknown de-duplication policy %r, expected one of: %s' % (policy, ', '.join(DEDUP_POLICIES)))
+    keep = np.ones(len(frame), dtype=bool)
+    if policy == 'none':
+        return keep
+
+    if policy in ('first', 'last'):
+        times = _epoch_seconds(frame)
+        rank = pd.Series(np.arange(len(deployments)), index=deployments.index)
+        row_rank = rank.reindex(ids).values
+        for dep_rank, (start, end) in enumerate(zip(deployments['start'].values, deployments['end'].values)):
+            covered = (times >= start) & (times <= end)
+            if policy == 'first':
+                keep &= ~(covered & (row_rank > dep_rank))
+            else:
+                keep &= ~(covered & (row_rank < dep_rank))
+
+    kept = keep.nonzero()[0]
+    keep[kept[frame.iloc[kept].duplicated(['DateTime'] + VALUE_COLUMNS).values]] = False
+    return keep
+
+
+def analyze(frame, policy=DEFAULT_DEDUP, tolerance=GAP_TOLERANCE):
+    """
+    Analyze deployment coverage of an unsorted combined frame, and de-duplicate it.
+
+    :param frame:  combined series in file order, see `read_series()`
+    :param str policy:  de-duplication policy, one of `DEDUP_POLICIES`
+    :param float tolerance:  gap threshold, as a multiple of the deployment's sample interval
+    :return: (boolean mask of rows to keep, coverage index DataFrame)
+    """
+    import numpy as np
+    import pandas as pd
+    if not len(frame):
+        return np.ones(0, dtype=bool), pd.DataFrame(columns=COVERAGE_COLUMNS)
+    times = _epoch_seconds(frame)
+    ids, names = deployment_ids(frame)
+
+    # per-deployment extents and median sample interval, ordered by start time
+    steps = np.diff(times)
+    same = ids[1:] == ids[:-1]
+    by_dep = pd.Series(times).groupby(ids)
+    deployments = pd.DataFrame({
+        'start': by_dep.min(),
+        'end': by_dep.max(),
+        'rows': by_dep.size(),
+        'interval': pd.Series(steps[same]).groupby(ids[1:][same]).median(),
+    })
+    deployments['interval'] = deployments['interval'].fillna(0).astype(np.int64)
+    deployments['name'] = names[deployments.index.values]
+    deployments.sort_values(['start', 'end'], kind='mergesort', inplace=True)
+
+    keep = dedupe(frame, ids, deployments, policy)
+    deployments['dropped'] = deployments['rows'] - pd.Series(keep).groupby(ids).sum().reindex(deployments.index).astype(np.int64)
+
+    records = []
+    for d in deployments.itertuples():
+        records.append(('deployment', d.name, d.start, d.end, d.rows, d.dropped, d.interval, ''))
+
+    # gaps and overlaps between deployments, relative to the latest end time seen so far
+    starts, ends = deployments['start'].values, deployments['end'].values
+    intervals, dep_names = deployments['interval'].values, deployments['name'].values
+    latest_end = np.maximum.accumulate(ends)
+    latest_idx = np.maximum.accumulate(np.where(ends >= latest_end, np.arange(len(ends)), 0))
+    for i in np.flatnonzero(starts[1:] > latest_end[:-1] + tolerance * intervals[1:]) + 1:
+        records.append(('gap', dep_names[i], latest_end[i - 1], starts[i], 0, 0, intervals[i], 'between deployments'))
+    for i in np.flatnonzero(starts[1:] <= latest_end[:-1]) + 1:
+        records.append(('overlap', dep_names[i], starts[i], min(ends[i], latest_end[i - 1]), 0, 0, intervals[i],
+                        'with %s' % dep_names[latest_idx[i - 1]]))
+    for i in np.flatnonzero(intervals[1:] != intervals[:-1]) + 1:
+        records.append(('interval', dep_names[i], starts[i], starts[i], 0, 0, intervals[i],
+                        '%ds -> %ds' % (intervals[i - 1], intervals[i])))
+
+    # gaps within a deployment
+    row_interval = deployments['interval'].reindex(ids[1:]).values
+    for i in np.flatnonzero(same & (row_interval > 0) & (steps > tolerance * row_interval)):
+        records.append(('gap', names[ids[i]], times[i], times[i + 1], 0, 0, row_interval[i], 'within deployment'))
+
+    coverage = pd.DataFrame.from_records(records, columns=['KIND', 'FILE', 'START', 'END', 'ROWS', 'DROPPED', 'INTERVAL_S', 'DETAIL'])
+    coverage['DAYS'] = (coverage['END'] - coverage['START']) / 86400.0
+    for col in 'START', 'END':
+        coverage[col] = pd.to_datetime(coverage[col], unit='s')
+    coverage.sort_values(['START', 'KIND'], kind='mergesort', inplace=True)
+    return keep, coverage[COVERAGE_COLUMNS].reset_index(drop=True)
+
+
+def file_start_markers(frame, keep):
+    """
+    Find kept rows which must newly carry a `FileStart` marker, because the
+    first row of their deployment was dropped.
+
+    :return: list of (row index, deployment filename)
+    """
+    import numpy as np
+    ids, names = deployment_ids(frame)
+    kept = np.flatnonzero(keep)
+    first_ids, first_pos = np.unique(ids[kept], return_index=True)
+    rows = kept[first_pos]
+    unmarked = frame['FileStart'].isnull().values[rows] & (first_ids > 0)
+    return [(i, names[ids[i]]) for i in rows[unmarked]]
+
+
+def write_coverage(fname, coverage):
+    """Write a coverage index CSV"""
+    coverage.to_csv(fname, index=False, date_format=TIME_FMT, float_format='%.3f')
+
+
+def load_coverage(fname):
+    """Load a coverage index CSV into a DataFrame, or `None` if it doesn't exist"""
+    import pandas as pd
+    if not os.path.exists(fname):
+        return None
+    return pd.read_csv(fname, parse_dates=['START', 'END'], keep_default_na=False)
+
+
+def deployment_coverage(coverage, basename):
+    """
+    Summarize the coverage index entries for a single deployment file.
+
+    :return: dict with ROWS, DROPPED, INTERVAL_S, GAP_BEFORE_DAYS, GAP_WITHIN_DAYS, OVERLAP_DAYS
+    """
+    entries = coverage[coverage['FILE'] == basename]
+    dep = entries[entries['KIND'] == 'deployment']
+    gaps = entries[entries['KIND'] == 'gap']
+    return {
+        'ROWS': int(dep['ROWS'].sum()),
+        'DROPPED': int(dep['DROPPED'].sum()),
+        'INTERVAL_S': int(dep['INTERVAL_S'].max()) if len(dep) else '',
+        'GAP_BEFORE_DAYS': round(gaps[gaps['DETAIL'] == 'between deployments']['DAYS'].sum(), 3),
+        'GAP_WITHIN_DAYS': round(gaps[gaps['DETAIL'] == 'within deployment']['DAYS'].sum(), 3),
+        'OVERLAP_DAYS': round(entries[entries['KIND'] == 'overlap']['DAYS'].sum(), 3),
+    }
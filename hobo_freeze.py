@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Detect freeze-thaw events in combined cave site temperature series.
+
+A site is considered frozen once its temperature drops to `HYSTERESIS`
+degrees below freezing (32 F), and thawed once it rises to `HYSTERESIS`
+degrees above, so that sensor noise around 32 F isn't counted as many
+tiny events. Each frozen period is a "freeze event", and a freeze event
+which ends in a thaw (rather than at the end of the data) completes a
+freeze-thaw cycle. Freezing degree-days are the integral of degrees
+below 32 F over time, regardless of hysteresis.
+
+Results are grouped by freeze season, July through June, labeled by the
+year in which it ends, so the 2015 season is the winter of 2014-2015, as
+downloaded in the `2015 Season` field season and measured by that
+season's ice surveys (see `ice_process.py`).
+
+All sites are analyzed together in one vectorized pass, producing two
+archive-wide CSV files:
+
+    freeze_thaw_events.csv    one row per freeze event
+    freeze_thaw_seasons.csv   per-site, per-season summary
+
+Data flagged by `hobo_anomaly.py` as a spike, out of limits, or an end
+failure is excluded, if a site's `CAVE_site_flags.csv` sidecar exists.
+
+hobo_freeze.py
+    Analyze all combined CAVE_site.csv files in the current directory
+
+hobo_freeze.py CAVE_site.csv...
+    Analyze just the specified files
+"""
+
+import os, os.path
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+from hobo_combine_all import ICE_SITES
+
+
+FREEZING = 32.0          # degrees F
+HYSTERESIS = 0.5         # degrees F either side of freezing, about our loggers' accuracy
+GAP_HRS = 6.0            # a longer gap in data ends any freeze event in progress
+SEASON_START_MONTH = 7   # freeze seasons run July through June
+
+EXCLUDED_FLAGS = [('Temperature', 'spike'), ('Temperature', 'limit'), ('All', 'end_failure')]
+
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+EVENTS_FNAME = 'freeze_thaw_events.csv'
+SEASONS_FNAME = 'freeze_thaw_seasons.csv'
+EVENT_COLUMNS = ['SITE', 'CAVE', 'SEASON', 'START', 'END', 'HOURS', 'MIN_TEMP', 'DEGREE_DAYS', 'THAWED']
+SEASON_COLUMNS = ['SITE', 'CAVE', 'ICE_CAVE', 'SEASON', 'START', 'END', 'DATA_DAYS', 'MIN_TEMP',
+                  'FREEZE_EVENTS', 'FREEZE_THAW_CYCLES', 'FROZEN_HOURS', 'LONGEST_FREEZE_HOURS',
+                  'FREEZING_DEGREE_DAYS', 'FIRST_FREEZE', 'LAST_THAW', 'FREEZE_SEASON_DAYS']
+
+
+def site_key(fname):
+    return os.path.splitext(os.path.basename(fname))[0]
+
+
+def load(fname):
+    """
+    Load a combined file's (epoch seconds, temperature) arrays, sorted by
+    time, without any rows flagged by `hobo_anomaly.py`.
+    """
+    import numpy as np
+    import pandas as pd
+    import hobo_anomaly
+    frame = pd.read_csv(fname, usecols=['DateTime', 'Temperature'])
+    times = pd.to_datetime(frame['DateTime'], format=TIME_FMT).values.astype('datetime64[s]').astype(np.int64)
+    temps = frame['Temperature'].values.astype(np.float64)
+    order = np.argsort(times, kind='mergesort')
+    times, temps = times[order], temps[order]
+
+    keep = ~np.isnan(temps)
+    flags_fname = hobo_anomaly.flags_fname(fname)
+    if os.path.exists(flags_fname):
+        flags = pd.read_csv(flags_fname)
+        flags = flags[[(var, flag) in EXCLUDED_FLAGS for var, flag in zip(flags['VARIABLE'], flags['FLAG'])]]
+        if len(flags):
+            starts = pd.to_datetime(flags['START'], format=TIME_FMT).values.astype('datetime64[s]').astype(np.int64)
+            ends = pd.to_datetime(flags['END'], format=TIME_FMT).values.astype('datetime64[s]').astype(np.int64)
+            # +1 at each flagged run's first row, -1 after its last, so a running sum marks flagged rows
+            marks = np.zeros(len(times) + 1, dtype=np.int64)
+            np.add.at(marks, np.searchsorted(times, starts, 'left'), 1)
+            np.add.at(marks, np.searchsorted(times, ends, 'right'), -1)
+            keep &= marks.cumsum()[:-1] == 0
+    return times[keep], temps[keep]
+
+
+def freeze_season(times):
+    """Freeze season (the year it ends) of each epoch seconds timestamp"""
+    import numpy as np
+    months = times.astype('datetime64[s]').astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    month = (months - years).astype(np.int64) + 1
+    return years.astype(np.int64) + 1970 + (month >= SEASON_START_MONTH)
+
+
+def detect(times, temps, site_ids, hysteresis=HYSTERESIS, gap_hrs=GAP_HRS):
+    """
+    Detect freeze events across many sites at once.
+
+    :param times:  epoch seconds of each record, sorted within each site
+    :param temps:  temperature of each record (F), without NaNs
+    :param site_ids:  integer site ID of each record, contiguous
+    :return: (per-event DataFrame, per-record DataFrame of site, season, freezing degree-days, and sample interval)
+    """
+    import numpy as np
+    import pandas as pd
+
+    n = len(times)
+    steps = np.diff(times)
+    same_site = site_ids[1:] == site_ids[:-1]
+
+    # each site's typical sample interval, and segments of data without a gap or change of site
+    interval = pd.Series(steps[same_site]).groupby(site_ids[1:][same_site]).median()
+    interval = interval.reindex(np.arange(site_ids.max() + 1 if n else 0)).fillna(0).values[site_ids]
+    breaks = np.concatenate(([True], ~same_site | (steps > gap_hrs * 3600)))
+    segment = breaks.cumsum()
+    last = np.concatenate((breaks[1:], [True]))  # last record of its segment
+
+    # hysteresis: definitely frozen or thawed beyond the dead band, otherwise as before
+    state = np.full(n, np.nan)
+    state[temps <= FREEZING - hysteresis] = 1
+    state[temps >= FREEZING + hysteresis] = 0
+    state = pd.Series(state).groupby(segment).ffill().values
+    frozen = state == 1
+
+    # each record stands for the time until the next one (or a typical interval, at the end of a segment)
+    duration = np.where(last, interval, np.concatenate((steps, [0]))).astype(np.float64)
+    degree_days = np.maximum(FREEZING - temps, 0) * duration / 86400.0
+    seasons = freeze_season(times)
+
+    # runs of frozen records within a segment are freeze events
+    prev_frozen = np.concatenate(([False], frozen[:-1])) & ~breaks
+    next_frozen = np.concatenate((frozen[1:], [False])) & ~last
+    starts = np.flatnonzero(frozen & ~prev_frozen)
+    ends = np.flatnonzero(frozen & ~next_frozen)
+    event_ids = np.cumsum(frozen & ~prev_frozen) - 1
+    by_event = pd.DataFrame({'event': event_ids[frozen], 'temp': temps[frozen], 'dd': degree_days[frozen]}).groupby('event')
+
+    events = pd.DataFrame({
+        'site': site_ids[starts],
+        'season': seasons[starts],
+        'start': times[starts],
+        'end': times[ends],
+        'hours': (times[ends] - times[starts] + duration[ends]) / 3600.0,
+        'min_temp': by_event['temp'].min().values,
+        'degree_days': by_event['dd'].sum().values,
+        # a thaw follows within the same segment, rather than the data ending (or a gap) while frozen
+        'thawed': ~last[ends],
+    })
+    records = pd.DataFrame({'site': site_ids, 'season': seasons, 'time': times, 'temp': temps,
+                            'degree_days': degree_days, 'duration': duration})
+    return events, records
+
+
+def summarize(events, records):
+    """Per-site, per-season summary of freeze events and freezing degree-days"""
+    import pandas as pd
+    by_record = records.groupby(['site', 'season'])
+    seasons = pd.DataFrame({
+        'start': by_record['time'].min(),
+        'end': by_record['time'].max(),
+        'data_days': by_record['duration'].sum() / 86400.0,
+        'min_temp': by_record['temp'].min(),
+        'degree_days': by_record['degree_days'].sum(),
+    })
+    by_event = events.groupby(['site', 'season'])
+    seasons['events'] = by_event.size()
+    seasons['cycles'] = events['thawed'].astype(int).groupby([events['site'], events['season']]).sum()
+    seasons['frozen_hours'] = by_event['hours'].sum()
+    seasons['longest_hours'] = by_event['hours'].max()
+    seasons['first_freeze'] = by_event['start'].min()
+    seasons['last_thaw'] = events[events['thawed']].groupby(['site', 'season'])['end'].max()
+    for col in 'events', 'cycles', 'frozen_hours', 'longest_hours':
+        seasons[col] = seasons[col].fillna(0)
+    seasons['season_days'] = (seasons['last_thaw'] - seasons['first_freeze']) / 86400.0
+    return seasons.reset_index()
+
+
+def _format_times(column):
+    import pandas as pd
+    return pd.to_datetime(column, unit='s').dt.strftime(TIME_FMT).where(column.notnull(), '')
+
+
+def analyze(fnames, hysteresis=HYSTERESIS):
+    """
+    Analyze freeze events for many combined files in one pass.
+
+    :return: (events DataFrame with `EVENT_COLUMNS`, seasons DataFrame with `SEASON_COLUMNS`)
+    """
+    import numpy as np
+
+    sites = [site_key(fname) for fname in fnames]
+    times, temps, site_ids = [], [], []
+    with metrics.stage('load'):
+        for i, fname in enumerate(fnames):
+            with metrics.file(fname) as rec:
+                t, temp = load(fname)
+                rec.rows = len(t)
+            times.append(t)
+            temps.append(temp)
+            site_ids.append(np.full(len(t), i, dtype=np.int64))
+
+    with metrics.stage('detect'):
+        events, records = detect(np.concatenate(times), np.concatenate(temps), np.concatenate(site_ids), hysteresis)
+        seasons = summarize(events, records)
+
+    sites = np.array(sites, dtype=object)
+    for frame in events, seasons:
+        frame['SITE'] = sites[frame['site'].values]
+        frame['CAVE'] = [site.split('_', 1)[0] for site in frame['SITE']]
+        frame['SEASON'] = frame['season']
+    events = events.rename(columns={'hours': 'HOURS', 'min_temp': 'MIN_TEMP', 'degree_days': 'DEGREE_DAYS'})
+    events['START'], events['END'] = _format_times(events['start']), _format_times(events['end'])
+    events['THAWED'] = events['thawed'].astype(int)
+
+    seasons = seasons.rename(columns={'data_days': 'DATA_DAYS', 'min_temp': 'MIN_TEMP', 'events': 'FREEZE_EVENTS',
+                                      'cycles': 'FREEZE_THAW_CYCLES', 'frozen_hours': 'FROZEN_HOURS',
+                                      'longest_hours': 'LONGEST_FREEZE_HOURS', 'degree_days': 'FREEZING_DEGREE_DAYS',
+                                      'season_days': 'FREEZE_SEASON_DAYS'})
+    seasons['ICE_CAVE'] = [int(cave in ICE_SITES) for cave in seasons['CAVE']]
+    for col, src in ('START', 'start'), ('END', 'end'), ('FIRST_FREEZE', 'first_freeze'), ('LAST_THAW', 'last_thaw'):
+        seasons[col] = _format_times(seasons[src])
+    for col in 'FREEZE_EVENTS', 'FREEZE_THAW_CYCLES':
+        seasons[col] = seasons[col].astype(int)
+    return events[EVENT_COLUMNS], seasons[SEASON_COLUMNS]
+
+
+def main(fnames, outdir='.', hysteresis=HYSTERESIS):
+    if not fnames:
+        from glob import glob
+        from hobo_combine_all import is_site_fname
+        fnames = sorted(filter(is_site_fname, glob('*.csv')))
+
+    with metrics.stage('freeze'):
+        events, seasons = analyze(fnames, hysteresis)
+        for fname, frame in (EVENTS_FNAME, events), (SEASONS_FNAME, seasons):
+            fname = os.path.join(outdir, fname)
+            with metrics.file(fname, bytes_read=0) as rec:
+                frame.to_csv(fname, index=False, float_format='%.3f')
+                rec.rows = len(frame)
+                rec.bytes_written = os.path.getsize(fname)
+
+    print '%d freeze events, %d freeze-thaw cycles, across %d site seasons' % (
+        len(events), events['THAWED'].sum(), len(seasons))
+    for row in seasons[seasons['FREEZE_EVENTS'] > 0].itertuples():
+        print '%-16s %d  %3d events  %3d cycles  %8.1f frozen hours  %7.2f degree-days' % (
+            row.SITE, row.SEASON, row.FREEZE_EVENTS, row.FREEZE_THAW_CYCLES, row.FROZEN_HOURS, row.FREEZING_DEGREE_DAYS)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Detect freeze-thaw events in combined cave site temperature series')
+    parser.add_argument('fnames', metavar='CAVE_site.csv', nargs='*', help='combined files to analyze (default: all)')
+    parser.add_argument('-o', '--outdir', default='.', help='directory for %s and %s (default: current directory)' % (EVENTS_FNAME, SEASONS_FNAME))
+    parser.add_argument('--hysteresis', type=float, default=HYSTERESIS, help='degrees F either side of freezing (default: %(default)s)')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.fnames, args.outdir, args.hysteresis)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+Build an aligned time x site matrix of all combined cave site series.
+
+Each combined `CAVE_site.csv` file has its own timestamps, and its own
+sample interval. This resamples every series onto one shared, regular time
+grid (the mean of the samples within each grid interval) and stores the
+result as one memory-mapped 2-D float32 array per variable, with a row for
+every grid interval and a column for every site:
+
+    matrix/matrix.json       grid start, interval, and shape
+    matrix/sites.csv         site metadata, one row per matrix column
+    matrix/Temperature.f32   raw float32 arrays, NaN where there's no data
+    matrix/RH.f32
+    matrix/Battery.f32
+
+Cross-site analysis can then slice the arrays directly, without re-parsing
+any CSV files:
+
+    from hobo_matrix import open_matrix
+    m = open_matrix('matrix')
+    out, deep = m.series('BALC_out'), m.series('BALC_deep')
+    times, temps = m.window('Temperature', '2015-01-01', '2015-02-01')
+
+hobo_matrix.py
+    Build the matrix from all combined CAVE_site.csv files in the current directory
+
+hobo_matrix.py CAVE_site.csv...
+    Build the matrix from just the specified files
+"""
+
+import os, os.path
+import json
+import csv
+from calendar import timegm
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+
+MATRIX_DIR = 'matrix'
+VARIABLES = ['Temperature', 'RH', 'Battery']
+DTYPE = 'float32'
+DEFAULT_INTERVAL = 60  # minutes
+
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+SITE_COLUMNS = ['COLUMN', 'SITE', 'CAVE', 'FNAME', 'START', 'END', 'ROWS', 'FILLED']
+
+
+def site_key(fname):
+    """`CAVE_site` key for a combined cave site filename"""
+    return os.path.splitext(os.path.basename(fname))[0]
+
+
+def _parse_time(s):
+    from datetime import datetime
+    return datetime.strptime(s, TIME_FMT)
+
+
+def time_extent(fname):
+    """
+    (first, last) timestamp of a sorted combined file, read from its first
+    and last lines rather than parsing the whole file.
+    """
+    with open(fname, 'rb') as f:
+        f.readline()  # header
+        first = f.readline()
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        last = f.read().rstrip('\r\n').rsplit('\n', 1)[-1]
+    if not first.strip():
+        return None, None
+    return _parse_time(first.split(',', 1)[0]), _parse_time(last.split(',', 1)[0])
+
+
+def load_series(fname):
+    """Load a combined cave site file as (epoch seconds, {variable: float64 values})"""
+    import numpy as np
+    import pandas as pd
+    frame = pd.read_csv(fname, usecols=['DateTime'] + VARIABLES)
+    times = pd.to_datetime(frame['DateTime'], format=TIME_FMT).values.astype('datetime64[s]').astype(np.int64)
+    return times, dict((var, frame[var].values.astype(np.float64)) for var in VARIABLES)
+
+
+def resample(times, values, start, interval, ntimes):
+    """
+    Vectorized mean of `values` within each interval of a regular grid.
+
+    :param times:  epoch seconds of each value
+    :param int start:  epoch seconds of the first grid interval
+    :param int interval:  grid interval in seconds
+    :param int ntimes:  number of grid intervals
+    :return: float32 array of length `ntimes`, NaN for intervals with no data
+    """
+    import numpy as np
+    bins = (times - start) // interval
+    valid = (bins >= 0) & (bins < ntimes) & ~np.isnan(values)
+    bins, values = bins[valid], values[valid]
+    sums = np.bincount(bins, weights=values, minlength=ntimes)
+    counts = np.bincount(bins, minlength=ntimes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).astype(DTYPE)
+
+
+def data_fname(dirname, var):
+    return os.path.join(dirname, '%s.f32' % var)
+
+
+def build(fnames, outdir=MATRIX_DIR, interval=DEFAULT_INTERVAL):
+    """
+    Resample combined cave site files onto a shared time grid and write the matrix.
+
+    :param list fnames:  combined `CAVE_site.csv` files, one matrix column each
+    :param str outdir:  matrix output directory
+    :param int interval:  grid interval in minutes
+    :return: the built `SiteMatrix`
+    """
+    import numpy as np
+
+    interval_s = int(interval * 60)
+    extents = {}
+    with metrics.stage('extent'):
+        for fname in fnames:
+            first, last = time_extent(fname)
+            if first is not None:
+                extents[fname] = first, last
+            else:
+                print 'Skipping empty file', fname
+    fnames = sorted(extents, key=site_key)
+    if not fnames:
+        raise ValueError('No data to build a matrix from')
+
+    start = timegm(min(first for first, last in extents.values()).timetuple())
+    start -= start % interval_s
+    ntimes = (timegm(max(last for first, last in extents.values()).timetuple()) - start) // interval_s + 1
+    shape = ntimes, len(fnames)
+    print 'Building %d x %d matrix (%d minute interval) in %s ...' % (shape[0], shape[1], interval, outdir)
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    arrays = dict((var, np.memmap(data_fname(outdir, var), dtype=DTYPE, mode='w+', shape=shape)) for var in VARIABLES)
+
+    sites = []
+    with metrics.stage('resample'):
+        for col, fname in enumerate(fnames):
+            with metrics.file(fname) as rec:
+                times, values = load_series(fname)
+                rec.rows = len(times)
+                for var in VARIABLES:
+                    arrays[var][:, col] = resample(times, values[var], start, interval_s, ntimes)
+            key = site_key(fname)
+            first, last = extents[fname]
+            filled = np.count_nonzero(~np.isnan(arrays['Temperature'][:, col]))
+            sites.append((col, key, key.split('_', 1)[0], os.path.basename(fname),
+                          first.strftime(TIME_FMT), last.strftime(TIME_FMT), len(times), filled))
+            print '%-16s %8d rows -> %8d intervals' % (key, len(times), filled)
+
+    for var in VARIABLES:
+        arrays[var].flush()
+    del arrays
+
+    with open(os.path.join(outdir, 'sites.csv'), 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(SITE_COLUMNS)
+        writer.writerows(sites)
+    with open(os.path.join(outdir, 'matrix.json'), 'w') as f:
+        json.dump({
+            'start': str(np.datetime64(start, 's')).replace('T', ' '),
+            'interval_s': interval_s,
+            'shape': list(shape),
+            'dtype': DTYPE,
+            'variables': VARIABLES,
+        }, f, indent=2)
+
+    return SiteMatrix(outdir)
+
+
+class SiteMatrix(object):
+    """
+    Read-only view of a built time x site matrix.
+
+    :ivar times:  numpy datetime64 timestamp of each row (the start of each grid interval)
+    :ivar list sites:  `CAVE_site` key of each column
+    :ivar list metadata:  dict of `sites.csv` fields for each column
+    """
+
+    def __init__(self, dirname=MATRIX_DIR):
+        import numpy as np
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'matrix.json')) as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.interval_s = meta['interval_s']
+        self.variables = meta['variables']
+        self.start = np.datetime64(meta['start'].replace(' ', 'T'), 's')
+        self.times = self.start + np.arange(self.shape[0]) * np.timedelta64(self.interval_s, 's')
+        with open(os.path.join(dirname, 'sites.csv'), 'rb') as f:
+            self.metadata = list(csv.DictReader(f))
+        self.sites = [row['SITE'] for row in self.metadata]
+        self._columns = dict((site, i) for i, site in enumerate(self.sites))
+        self._arrays = {}
+
+    def __getitem__(self, var):
+        """The whole memory-mapped (time x site) array for a variable"""
+        import numpy as np
+        if var not in self._arrays:
+            if var not in self.variables:
+                raise KeyError(var)
+            self._arrays[var] = np.memmap(data_fname(self.dirname, var), dtype=DTYPE, mode='r', shape=self.shape)
+        return self._arrays[var]
+
+    def column(self, site):
+        """Matrix column index for a `CAVE_site` key"""
+        return self._columns[site]
+
+    def series(self, site, var='Temperature'):
+        """One site's resampled series for a variable"""
+        return self[var][:, self.column(site)]
+
+    def row(self, when):
+        """Matrix row index of the grid interval containing a timestamp (clipped to the grid)"""
+        import numpy as np
+        offset = (np.datetime64(when, 's') - self.start).astype(np.int64) // self.interval_s
+        return int(min(max(offset, 0), self.shape[0]))
+
+    def window(self, var, start=None, end=None, sites=None):
+        """
+        Slice a time range of a variable, optionally for a subset of sites.
+
+        :param start:  first timestamp (inclusive), default the start of the grid
+        :param end:  last timestamp (exclusive), default the end of the grid
+        :param list sites:  `CAVE_site` keys, default all columns
+        :return: (datetime64 times, 2-D array of time x site)
+        """
+        i = self.row(start) if start is not None else 0
+        j = self.row(end) if end is not None else self.shape[0]
+        data = self[var][i:j]
+        if sites is not None:
+            data = data[:, [self.column(site) for site in sites]]
+        return self.times[i:j], data
+
+
+def open_matrix(dirname=MATRIX_DIR):
+    """Open a built time x site matrix for reading"""
+    return SiteMatrix(dirname)
+
+
+def main(fnames, outdir=MATRIX_DIR, interval=DEFAULT_INTERVAL):
+    if not fnames:
+        from glob import glob
+        from hobo_combine_all import is_site_fname
+        fnames = sorted(filter(is_site_fname, glob('*.csv')))
+    with metrics.stage('matrix'):
+        build(fnames, outdir, interval)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build an aligned time x site matrix of combined cave site series')
+    parser.add_argument('fnames', metavar='CAVE_site.csv', nargs='*', help='combined files to include (default: all)')
+    parser.add_argument('-o', '--outdir', default=MATRIX_DIR, help='matrix output directory (default: %(default)s)')
+    parser.add_argument('-i', '--interval', type=int, default=DEFAULT_INTERVAL, help='grid interval in minutes (default: %(default)s)')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.fnames, args.outdir, args.interval)
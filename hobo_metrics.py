@@ -0,0 +1,249 @@
+"""
+Timing and resource instrumentation shared by our processing scripts.
+
+Each script records its work against the module-level `metrics` object,
+as named stages (eg. "combine", "sort") and as individual files processed
+within those stages:
+
+    from hobo_metrics import metrics
+
+    with metrics.stage('combine'):
+        for fname in fnames:
+            with metrics.file(fname) as rec:
+                rec.rows = process(fname)
+
+Every record captures wall time, rows processed, bytes read and written,
+and the process's peak resident memory when the record completed. Records
+are only kept once `keep_records` is set (as `run()` does for
+`--metrics-json`), so long-running processes like `hobo_server.py` and
+`hobo_pipeline.py --watch` don't accumulate them forever; file totals are
+still rolled up into any enclosing stage.
+
+Work done in `multiprocessing` worker processes is recorded against the
+worker's own copy of `metrics`, so workers gather their records with
+`collect()` and return them for the parent to `merge()`.
+
+Entry points add the standard `--profile` and `--metrics-json` options
+with `add_arguments()`, then invoke their main function with `run()`.
+"""
+
+import sys, os, os.path
+import json
+import platform
+from time import time
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows
+
+
+def peak_rss():
+    """
+    Peak resident set size in bytes of this process, or of its largest
+    finished child process (eg. a pool worker) if that was larger, or
+    `None` if unknown
+    """
+    if resource is not None:
+        maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024  # macOS reports bytes, Linux KiB
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss)  # Windows tracks peak working set
+
+
+class Record(object):
+    """Measurements for a single stage or file"""
+    __slots__ = 'kind', 'name', 'stage', 'start', 'elapsed', 'rows', 'bytes_read', 'bytes_written', 'peak_rss'
+
+    def __init__(self, kind, name, stage=None):
+        self.kind, self.name, self.stage = kind, name, stage
+        self.start = time()
+        self.elapsed = None
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = None
+
+    def finish(self):
+        self.elapsed = time() - self.start
+        self.peak_rss = peak_rss()
+
+    def as_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__ if attr != 'start')
+
+    @classmethod
+    def from_dict(cls, d):
+        rec = cls(d['kind'], d['name'], d['stage'])
+        for attr in 'elapsed', 'rows', 'bytes_read', 'bytes_written', 'peak_rss':
+            setattr(rec, attr, d[attr])
+        return rec
+
+
+class Metrics(object):
+    """
+    Collection of stage and file measurements for one run of a script.
+
+    :ivar str program:  name of the script being measured
+    :ivar list stages:  `Record` for each completed stage
+    :ivar list files:  `Record` for each completed file
+    :ivar bool keep_records:  whether completed records are kept in `stages` and `files`
+    """
+
+    def __init__(self, program=None, keep_records=False):
+        self.program = program or os.path.basename(sys.argv[0])
+        self.started = datetime.now()
+        self.tstart = time()
+        self.stages = []
+        self.files = []
+        self.keep_records = keep_records
+        self._stage_stack = []
+        self._collectors = []
+
+    @property
+    def current_stage(self):
+        return self._stage_stack[-1] if self._stage_stack else None
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a named processing stage; file records within are totalled into it"""
+        rec = Record('stage', name, self.current_stage.name if self.current_stage else None)
+        self._stage_stack.append(rec)
+        try:
+            yield rec
+        finally:
+            self._stage_stack.pop()
+            rec.finish()
+            self._completed(rec)
+
+    @contextmanager
+    def file(self, fname, bytes_read=None):
+        """
+        Measure processing of a single file. Bytes read defaults to the
+        size of `fname`, which callers may override along with rows and
+        bytes written.
+        """
+        stage = self.current_stage
+        rec = Record('file', fname, stage.name if stage else None)
+        if bytes_read is None and os.path.isfile(fname):
+            bytes_read = os.path.getsize(fname)
+        rec.bytes_read = bytes_read or 0
+        try:
+            yield rec
+        finally:
+            rec.finish()
+            self._completed(rec)
+
+    def _completed(self, rec):
+        if self.keep_records:
+            (self.stages if rec.kind == 'stage' else self.files).append(rec)
+        for collected in self._collectors:
+            collected.append(rec.as_dict())
+        if rec.kind == 'file':
+            for parent in self._stage_stack:
+                parent.rows += rec.rows
+                parent.bytes_read += rec.bytes_read
+                parent.bytes_written += rec.bytes_written
+
+    @contextmanager
+    def collect(self):
+        """
+        Gather the records completed within, as a list of dicts which a
+        worker process can return to its parent for `merge()`
+        """
+        collected = []
+        self._collectors.append(collected)
+        try:
+            yield collected
+        finally:
+            self._collectors.remove(collected)
+
+    def merge(self, records):
+        """
+        Add records gathered by `collect()` in a worker process, as though
+        they were completed here within the current stage
+        """
+        stage = self.current_stage
+        for d in records:
+            rec = Record.from_dict(d)
+            if stage and not rec.stage:
+                rec.stage = stage.name
+            self._completed(rec)
+
+    def as_dict(self):
+        return {
+            'program': self.program,
+            'argv': sys.argv[1:],
+            'python': platform.python_version(),
+            'started': self.started.strftime('%Y-%m-%dT%H:%M:%S'),
+            'elapsed': time() - self.tstart,
+            'peak_rss': peak_rss(),
+            'stages': [rec.as_dict() for rec in self.stages],
+            'files': [rec.as_dict() for rec in self.files],
+        }
+
+    def dump(self, fname):
+        """Write all measurements to a JSON file"""
+        with open(fname, 'w') as outf:
+            json.dump(self.as_dict(), outf, indent=2)
+
+    def report(self, out=None):
+        """Print a human-readable summary of stage measurements"""
+        out = out or sys.stderr
+        out.write('\n%-24s %9s %10s %10s %10s %9s\n' % ('STAGE', 'TIME', 'ROWS', 'READ', 'WRITTEN', 'PEAK RSS'))
+        for rec in sorted(self.stages, key=lambda rec: rec.start):
+            out.write('%-24s %8.2fs %10d %10s %10s %9s\n' % (
+                ('  ' if rec.stage else '') + rec.name, rec.elapsed, rec.rows,
+                _size(rec.bytes_read), _size(rec.bytes_written), _size(rec.peak_rss)))
+        out.write('%-24s %8.2fs %10s %10s %10s %9s\n' % ('TOTAL', time() - self.tstart, '', '', '', _size(peak_rss())))
+
+
+def _size(n):
+    """Human-readable byte count"""
+    if n is None:
+        return '?'
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(n) < 1024.0 or unit == 'G':
+            return ('%d%s' if unit == 'B' else '%.1f%s') % (n, unit)
+        n /= 1024.0
+
+
+metrics = Metrics()
+
+
+def add_arguments(parser):
+    """Add our standard instrumentation options to an `argparse` parser"""
+    parser.add_argument('--profile', metavar='FILE', help='write cProfile statistics to FILE')
+    parser.add_argument('--metrics-json', metavar='FILE', help='write timing and resource metrics to FILE as JSON')
+
+
+def run(args, func, *func_args, **func_kwargs):
+    """
+    Invoke an entry point's main function, honoring the `--profile` and
+    `--metrics-json` options parsed into `args`. The whole run is recorded
+    as a stage named for the program.
+    """
+    metrics.keep_records = bool(args.metrics_json)
+    try:
+        with metrics.stage(os.path.splitext(metrics.program)[0]):
+            if args.profile:
+                import cProfile
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(func, *func_args, **func_kwargs)
+                finally:
+                    profiler.dump_stats(args.profile)
+                    sys.stderr.write('Wrote profile statistics to %s\n' % args.profile)
+            else:
+                return func(*func_args, **func_kwargs)
+    finally:
+        if args.metrics_json:
+            metrics.dump(args.metrics_json)
+            metrics.report()
+            sys.stderr.write('Wrote metrics to %s\n' % args.metrics_json)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+Run the whole HOBO data processing workflow, rebuilding only what's changed.
+
+The workflow is modeled as a graph of tasks, each with input files, output
+files, and the tasks it depends on:
+
+    status             hobo_check_status.py, over all HOBO and CSV files
+    truncate:FILE      hobo_truncate_bad_files.py, for each exported CSV file
+    combine:CAVE_site  hobo_combine_all.py, for each cave site's CSV files
+    plot:CAVE_site     hobo_plot.py, for each combined cave site file
+    anomaly:CAVE_site  hobo_anomaly.py, for each combined cave site file
+    matrix             hobo_matrix.py, over all combined cave site files
+    climatology        hobo_climatology.py, over all combined cave site files
+    freeze             hobo_freeze.py, over all combined cave site files and their anomaly flags
+    summary            hobo_summary_spreadsheet.py, over all CSV files
+
+Like `make`, a task is run only if it's out of date: the size or
+modification time of any of its inputs differs from when it last
+succeeded, its set of inputs or its options have changed, or one of its
+outputs is missing. Task state is kept in `.hobo_pipeline.json` in the output
+directory. Tasks which don't depend on each other (eg. the combine and
+plot of different cave sites) are run concurrently.
+
+hobo_pipeline.py [CAVE...]
+    Bring everything (or just the specified caves) up to date
+
+hobo_pipeline.py -n
+    Show which tasks are out of date, without running them
+
+hobo_pipeline.py --watch
+    Keep watching for new or changed exports in `Climate/Excel Files`,
+    and rebuild whatever they affect
+"""
+
+import sys, os, os.path
+import json
+import traceback
+from time import sleep
+from collections import OrderedDict
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+
+OUTDIR = '_Final Analysis'
+STATE_FNAME = '.hobo_pipeline.json'
+POLL_INTERVAL = 10.0  # seconds between scans in watch mode
+
+
+def signature(fnames):
+    """{filename: [size, mtime]} of existing files"""
+    sig = {}
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+        except OSError:
+            continue
+        sig[fname] = [st.st_size, st.st_mtime]
+    return sig
+
+
+class State(object):
+    """Input signatures and options of each task as of its last successful run"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.tasks = {}
+        if os.path.exists(fname):
+            with open(fname) as f:
+                self.tasks = json.load(f)
+
+    def is_current(self, task, inputs):
+        if any(not os.path.exists(fname) for fname in task.outputs):
+            return False
+        return self.tasks.get(task.name) == {'inputs': signature(inputs), 'args': repr(task.args)}
+
+    def mark(self, name, inputs, args):
+        self.tasks[name] = {'inputs': signature(inputs), 'args': repr(args)}
+
+    def save(self):
+        tmpfname = self.fname + '.tmp'
+        with open(tmpfname, 'w') as f:
+            json.dump(self.tasks, f, indent=0, sort_keys=True)
+        if os.path.exists(self.fname):
+            os.remove(self.fname)  # Windows can't rename over an existing file
+        os.rename(tmpfname, self.fname)
+
+
+class Task(object):
+    """
+    A unit of work in the pipeline graph.
+
+    :ivar str name:  unique task name, eg. "combine:BALC_out"
+    :ivar inputs:  list of input filenames, or a function returning them, evaluated once dependencies have run
+    :ivar list outputs:  output filenames
+    :ivar action:  module-level function to call with `args` (preceded by the
+                   resolved inputs if `pass_inputs`), optionally returning a
+                   list of extra filenames which are now up to date
+    :ivar list deps:  names of tasks which must run first
+    """
+
+    def __init__(self, name, inputs, outputs, action, args=(), deps=(), pass_inputs=False):
+        self.name, self.inputs, self.outputs = name, inputs, list(outputs)
+        self.action, self.args, self.deps = action, args, list(deps)
+        self.pass_inputs = pass_inputs
+
+    @property
+    def kind(self):
+        return self.name.split(':', 1)[0]
+
+    def resolve_inputs(self):
+        return sorted(self.inputs() if callable(self.inputs) else self.inputs)
+
+
+# Task actions are module-level functions so they can run in worker processes.
+
+def _status(rootdir, sites):
+    import hobo_check_status
+    hobo_check_status.main(rootdir, sites)
+
+def _truncate(fname):
+    import hobo_truncate_bad_files
+    if hobo_truncate_bad_files.copy(fname):
+        return [fname.rsplit('.', 1)[0] + '_cropped.csv']  # already passed QC, no need to check it again
+    return []
+
+def _combine(fnames, combined, dedup, derived):
+    import hobo_combine_all, hobo_coverage
+    outdir = os.path.dirname(combined)
+    for fname in (combined, hobo_coverage.coverage_fname(combined)):
+        if os.path.exists(fname):
+            os.remove(fname)  # rebuilt from scratch, as combining appends
+    for fname in sorted(fnames):
+        hobo_combine_all.combine_file(fname, outdir, derived)
+    hobo_combine_all.sort_file(combined, dedup)
+
+def _plot(combined):
+    import hobo_plot
+    hobo_plot.hobo_plot(combined)
+
+def _anomaly(combined):
+    import hobo_anomaly
+    hobo_anomaly.process(combined)
+
+def _matrix(combined_fnames, outdir):
+    import hobo_matrix
+    hobo_matrix.main(combined_fnames, outdir)
+
+def _climatology(combined_fnames, cachedir):
+    import hobo_climatology
+    hobo_climatology.main(combined_fnames, cachedir)
+
+def _freeze(combined_fnames, outdir):
+    import hobo_freeze
+    hobo_freeze.main(combined_fnames, outdir)
+
+def _summary(rootdir, outfname, coverage_dir, derived):
+    import hobo_summary_spreadsheet
+    hobo_summary_spreadsheet.csv_main(rootdir, outfname, coverage_dir, derived)
+
+
+def _run(job):
+    """
+    Run a (name, action, args) job, return (name, extra filenames or None,
+    error or None, metrics records)
+    """
+    name, action, args = job
+    with metrics.collect() as records:
+        try:
+            extra, error = action(*args) or [], None
+        except Exception:
+            extra, error = None, traceback.format_exc()
+    return name, extra, error, records
+
+
+class Pipeline(object):
+    """The task graph for an archive, and a runner for it"""
+
+    def __init__(self, rootdir='.', outdir=None, sites=None, dedup=None, jobs=1, derived=False):
+        import hobo_coverage
+        self.rootdir = rootdir
+        self.outdir = outdir or os.path.join(rootdir, OUTDIR)
+        self.sites = sites
+        self.dedup = dedup or hobo_coverage.DEFAULT_DEDUP
+        self.jobs = jobs
+        self.derived = derived
+        self.state = State(os.path.join(self.outdir, STATE_FNAME))
+
+    def exported_files(self):
+        """Exported HOBO CSV files, as `hobo_combine_all.py` expects: `2017 Season/Climate/Excel Files/*.csv`"""
+        import hobo_combine_all
+        outdir = os.path.abspath(self.outdir)
+        return sorted(fname for fname in hobo_combine_all.find_files(self.rootdir, self.sites)
+                      if 'Climate' in fname and 'Excel' in fname and not fname.endswith('.NEW.csv')
+                      and not os.path.abspath(fname).startswith(outdir))
+
+    def hobo_files(self):
+        """HOBO logger files, filtered by cave like `hobo_combine_all.find_files()`"""
+        import hobo_combine_all
+        return sorted(fname for ext in ('*.hobo', '*.hproj') for fname in hobo_combine_all.rglob(self.rootdir, ext)
+                      if not self.sites or os.path.basename(fname).split('_', 1)[0] in self.sites)
+
+    def site_files(self, key):
+        """Exported CSV files for a `CAVE_site` key, as they are right now"""
+        import hobo_combine_all
+        return [fname for fname in self.exported_files() if '%s_%s' % hobo_combine_all.split_fname(fname)[1:3] == key]
+
+    def tasks(self):
+        """Build the task graph, in dependency order"""
+        import hobo_combine_all, hobo_coverage, hobo_climatology, hobo_freeze, hobo_anomaly, hobo_matrix
+        exported = self.exported_files()
+        tasks = []
+        by_site = OrderedDict()
+        for fname in exported:
+            season, cave, site, basename = hobo_combine_all.split_fname(fname)
+            by_site.setdefault('%s_%s' % (cave, site), []).append(fname)
+            tasks.append(Task('truncate:' + os.path.relpath(fname, self.rootdir), [fname], [], _truncate, (fname,)))
+        tasks.append(Task('status', lambda: self.exported_files() + self.hobo_files(), [], _status,
+                          (self.rootdir, self.sites), [t.name for t in tasks]))
+
+        coverage_fnames, combined_fnames = [], []
+        for key, fnames in sorted(by_site.items()):
+            combined = os.path.join(self.outdir, key + '.csv')
+            coverage = hobo_coverage.coverage_fname(combined)
+            coverage_fnames.append(coverage)
+            combined_fnames.append(combined)
+            truncates = ['truncate:' + os.path.relpath(fname, self.rootdir) for fname in fnames]
+            tasks.append(Task('combine:' + key, lambda key=key: self.site_files(key), [combined, coverage], _combine,
+                              (combined, self.dedup, self.derived), truncates, pass_inputs=True))
+            tasks.append(Task('plot:' + key, [combined, coverage], [combined.rsplit('.', 1)[0] + '.png'], _plot,
+                              (combined,), ['combine:' + key]))
+            tasks.append(Task('anomaly:' + key, [combined], [hobo_anomaly.flags_fname(combined)], _anomaly,
+                              (combined,), ['combine:' + key]))
+
+        combines = [t.name for t in tasks if t.kind == 'combine']
+        anomalies = [t.name for t in tasks if t.kind == 'anomaly']
+        matrix_dir = os.path.join(self.outdir, hobo_matrix.MATRIX_DIR)
+        matrix_fnames = [hobo_matrix.data_fname(matrix_dir, var) for var in hobo_matrix.VARIABLES]
+        tasks.append(Task('matrix', combined_fnames, [os.path.join(matrix_dir, 'matrix.json')] + matrix_fnames,
+                          _matrix, (combined_fnames, matrix_dir), combines))
+        tasks.append(Task('climatology', combined_fnames, map(hobo_climatology.normals_fname, combined_fnames), _climatology,
+                          (combined_fnames, os.path.join(self.outdir, hobo_climatology.CACHE_DIR)), combines))
+        tasks.append(Task('freeze', combined_fnames + map(hobo_anomaly.flags_fname, combined_fnames),
+                          [os.path.join(self.outdir, fname) for fname in (hobo_freeze.EVENTS_FNAME, hobo_freeze.SEASONS_FNAME)],
+                          _freeze, (combined_fnames, self.outdir), anomalies))
+
+        summary = os.path.join(self.outdir, 'summary.csv')
+        tasks.append(Task('summary', lambda: self.exported_files() + coverage_fnames, [summary], _summary,
+                          (self.rootdir, summary, self.outdir, self.derived), combines))
+        return tasks
+
+    def run(self, dry_run=False):
+        """
+        Run every out-of-date task, a "wave" of mutually independent tasks at
+        a time. Return the number of failed tasks.
+        """
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        tasks = OrderedDict((t.name, t) for t in self.tasks())
+        done, failed, ran = set(), set(), set()
+        pool = None
+        if self.jobs > 1 and not dry_run:
+            from multiprocessing import Pool
+            pool = Pool(self.jobs)
+
+        try:
+            while len(done) + len(failed) < len(tasks):
+                wave = [t for name, t in tasks.items() if name not in done and name not in failed
+                        and all(dep in done or dep in failed for dep in t.deps)]
+                stale = []
+                for task in wave:
+                    if any(dep in failed for dep in task.deps):
+                        print 'Skipping %s, as a task it depends on failed' % task.name
+                        failed.add(task.name)
+                        continue
+                    inputs = task.resolve_inputs()
+                    if self.state.is_current(task, inputs) and not any(dep in ran for dep in task.deps if dry_run):
+                        done.add(task.name)
+                    else:
+                        stale.append((task, inputs))
+                if not stale:
+                    continue
+
+                if dry_run:
+                    for task, inputs in stale:
+                        print 'Out of date:', task.name
+                        ran.add(task.name)
+                        done.add(task.name)
+                    continue
+
+                jobs = [(task.name, task.action, ((inputs,) if task.pass_inputs else ()) + tuple(task.args))
+                        for task, inputs in stale]
+                inputs_by_name = dict((task.name, inputs) for task, inputs in stale)
+                with metrics.stage('+'.join(sorted(set(task.kind for task, inputs in stale)))):
+                    pooled = pool is not None and len(jobs) > 1
+                    if pooled:
+                        results = pool.imap_unordered(_run, jobs)
+                    else:
+                        results = (_run(job) for job in jobs)
+                    for name, extra, error, records in results:
+                        if pooled:
+                            metrics.merge(records)
+                        if error:
+                            print >> sys.stderr, 'FAILED %s:\n%s' % (name, error)
+                            failed.add(name)
+                            continue
+                        self.state.mark(name, inputs_by_name[name], tasks[name].args)
+                        for fname in extra:
+                            self.state.mark('truncate:' + os.path.relpath(fname, self.rootdir), [fname], (fname,))
+                        ran.add(name)
+                        done.add(name)
+                        self.state.save()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if not dry_run:
+            print '\n%d task(s) run, %d up to date' % (len(ran), len(done) - len(ran))
+        elif not ran:
+            print 'Nothing to do, all %d task(s) are up to date' % len(done)
+        if failed:
+            print >> sys.stderr, '%d task(s) failed: %s' % (len(failed), ', '.join(sorted(failed)))
+        return len(failed)
+
+    def watch(self, interval=POLL_INTERVAL):
+        """
+        Poll for new or changed exports and HOBO files, and bring the
+        pipeline up to date once they've stopped changing (so we don't
+        process a file which is still being copied in).
+        """
+        print 'Watching %s for new data (Ctrl-C to stop) ...' % os.path.abspath(self.rootdir)
+        built, last = None, None
+        while True:
+            current = signature(self.exported_files() + self.hobo_files())
+            if current != built and current == last:
+                self.run()
+                built = signature(self.exported_files() + self.hobo_files())  # truncation may rename files
+                print '\nWatching for new data ...'
+            last = current
+            sleep(interval)
+
+
+def main(rootdir='.', outdir=None, sites=None, dedup=None, jobs=1, dry_run=False, watch=False, interval=POLL_INTERVAL,
+         derived=False):
+    pipeline = Pipeline(rootdir, outdir, sites, dedup, jobs, derived)
+    if watch:
+        try:
+            pipeline.watch(interval)
+        except KeyboardInterrupt:
+            pass
+        return 0
+    return pipeline.run(dry_run)
+
+
+if __name__ == '__main__':
+    import argparse
+    import hobo_coverage
+    parser = argparse.ArgumentParser(description='Run the HOBO data processing workflow, rebuilding only what has changed')
+    parser.add_argument('sites', metavar='CAVE', nargs='*', help='caves to process (default: all)')
+    parser.add_argument('-d', '--rootdir', default='.', help='archive root directory (default: current directory)')
+    parser.add_argument('-o', '--outdir', help='output directory for combined files (default: ROOTDIR/%s)' % OUTDIR)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of tasks to run in parallel')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only show which tasks are out of date')
+    parser.add_argument('--dedup', choices=hobo_coverage.DEDUP_POLICIES, default=hobo_coverage.DEFAULT_DEDUP,
+                        help='duplicate record policy (default: %(default)s)')
+    parser.add_argument('--derived', action='store_true', help='add derived psychrometric columns to combined files and summary')
+    parser.add_argument('--watch', action='store_true', help='keep watching for new data and rebuild as it arrives')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='watch mode polling interval in seconds (default: %(default)s)')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    failures = hobo_metrics.run(args, main, args.rootdir, args.outdir, args.sites or None, args.dedup,
+                                args.jobs, args.dry_run, args.watch, args.interval, args.derived)
+    sys.exit(1 if failures else 0)
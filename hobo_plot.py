@@ -11,16 +11,39 @@ hobo_plot.py CAVE_site
 2016 David A. Riggs, LABE Physical Science Tech
 """
 
-from time import time
-tstart = time()
 import sys, os, os.path
 
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as pyplot
-from matplotlib import gridspec
-pyplot.style.use('ggplot')
-print 'Loading dependencies took %.2fs\n' % (time() - tstart)
+from hobo_metrics import metrics
+import hobo_metrics
+
+# Heavy dependencies are imported on first use by `_import_dependencies()`,
+# so that `--help` and other trivial invocations start quickly.
+pd = None
+np = None
+pyplot = None
+gridspec = None
+
+
+def _import_dependencies(interactive=False):
+    """
+    Import Pandas, NumPy, and Matplotlib if we haven't already.
+
+    Non-interactive runs select the Agg backend before PyPlot is imported,
+    which avoids initializing a GUI toolkit we'll never use. An explicit
+    `MPLBACKEND` environment variable is honored.
+    """
+    global pd, np, pyplot, gridspec
+    if pyplot is not None:
+        return
+    with metrics.stage('import'):
+        import matplotlib
+        if not interactive and not os.environ.get('MPLBACKEND') and 'matplotlib.pyplot' not in sys.modules:
+            matplotlib.use('Agg')
+        import pandas as pd
+        import numpy as np
+        import matplotlib.pyplot as pyplot
+        from matplotlib import gridspec
+        pyplot.style.use('ggplot')
 
 
 def _load_modified_csv(fname):
@@ -50,41 +73,149 @@ def _load_hoboware_csv(fname):
     return dataframe
 
 def load(fname):
-    """Load a .CSV file into a Pandas DataFrame"""
+    """Load a .CSV file, or a compact .HCA archive of one, into a Pandas DataFrame"""
+    global pd
+    if pd is None:
+        import pandas as pd  # loading data doesn't require Matplotlib
+    if fname.lower().endswith('.hca'):
+        import hobo_archive
+        return hobo_archive.load_frame(fname)
     if 'Plot Title:' in open(fname,'r').readline():
         return _load_hoboware_csv(fname)
     else:
         return _load_modified_csv(fname)
     
 
-def hobo_plot(fname, interactive=False, output_format='png'):
-    """Plot a file"""
-    print 'Plotting %s...' % fname,
-    data = load(fname)
-    #daily_avg = data.resample('D', how='mean')
-    daily_med = data.resample('D').median()
-    daily_max = data.resample('D').max()
-    daily_min = data.resample('D').min()
+RH_LINES = zip([1, 25, 50, 75, 100], [(1,0,0), (0.75,0,0.25), (0.5,0,0.5), (0.25,0,0.75), (0,0,1)])
+COVERAGE_COLORS = [('gap', '#ff0000'), ('overlap', '#ffa500')]
+NORMAL_BAND = 'P10', 'P90'  # climatology percentile band overlaid by `--normals`
 
-    fig = pyplot.figure()
-    title = os.path.basename(fname).rsplit('.',1)[0].replace('_',' ')
-    fig.suptitle('Lava Beds National Monument, Cave I&M - '+title, fontsize=14)
-    
-    gs = gridspec.GridSpec(3, 1, height_ratios=[3, 3, 1])
-    ax0 = pyplot.subplot(gs[0])
-    ax1 = pyplot.subplot(gs[1], sharex=ax0)
-    ax2 = pyplot.subplot(gs[2], sharex=ax0)
-    
-    ax0.set_title(u'Temperature (\N{DEGREE SIGN}F)', fontsize=12)
-    ax0.fill_between(daily_min['Temperature'].index, daily_min['Temperature'], daily_max['Temperature'], color='darkgrey')
-    ax0.plot(daily_min['Temperature'], color='b')
-    ax0.plot(daily_max['Temperature'], color='r')
-    ax0.plot(daily_med['Temperature'], color='black')
-    ymin, ymax = ax0.get_ylim()
-    if ymin <= 32.0 <= ymax:
-        ax0.axhline(32.0, color='b', linestyle='--', linewidth=0.5, zorder=0.75)
-    ax0.xaxis.set_ticks_position('bottom')
-    pyplot.setp(ax0.get_xticklabels(), fontsize=6, visible=False)
+
+class PlotTemplate(object):
+    """
+    A figure layout, with its axes, lines, and marker collections, which is
+    built once and then re-used for each site plotted by updating the data
+    on its existing artists. Deployment markers and coverage spans are a
+    single collection per axis, rather than an artist per marker.
+    """
+    columns = 'Temperature', 'RH', 'Battery'
+
+    def __init__(self):
+        from matplotlib.collections import LineCollection, PolyCollection
+        self.fig = pyplot.figure()
+        self.title = self.fig.suptitle('', fontsize=14)
+
+        gs = gridspec.GridSpec(3, 1, height_ratios=[3, 3, 1])
+        ax0 = self.fig.add_subplot(gs[0])
+        ax1 = self.fig.add_subplot(gs[1], sharex=ax0)
+        ax2 = self.fig.add_subplot(gs[2], sharex=ax0)
+        self.axes = ax0, ax1, ax2
+
+        ax0.set_title(u'Temperature (\N{DEGREE SIGN}F)', fontsize=12)
+        ax1.set_title('Relative Humidity (%)', fontsize=12)
+        ax2.set_title('Battery (V)', fontsize=12)
+        for ax in self.axes:
+            ax.xaxis_date()
+            ax.xaxis.set_ticks_position('bottom')
+        for ax in ax0, ax1:
+            pyplot.setp(ax.get_xticklabels(), fontsize=6, visible=False)
+
+        # daily min (blue), max (red), and median (black, except for battery)
+        self.fills = [None, None, None]
+        self.bands = [None, None, None]
+        self.lines = []
+        for ax, colors in zip(self.axes, [('b', 'r', 'black')] * 2 + [('b', 'r')]):
+            self.lines.append([ax.plot([], [], color=color)[0] for color in colors])
+
+        # reference lines, shown only where they fall within the data's range
+        self.references = [
+            [(32.0, ax0.axhline(32.0, color='b', linestyle='--', linewidth=0.5, zorder=0.75))],
+            [(rh, ax1.axhline(rh, color=color, linestyle='--', linewidth=0.5, zorder=0.75)) for rh, color in RH_LINES],
+            [(2.625, ax2.axhline(2.625, color='r', linestyle='--', linewidth=0.5, zorder=0.75))],
+        ]
+
+        # markers for each individual data logger, and coverage gaps and overlaps
+        self.markers, self.spans = [], []
+        for ax in self.axes:
+            markers = LineCollection([], linestyles='--', linewidths=0.5, colors='#808080', zorder=0.5,
+                                     transform=ax.get_xaxis_transform())
+            ax.add_collection(markers, autolim=False)
+            self.markers.append(markers)
+            spans = {}
+            for kind, color in COVERAGE_COLORS:
+                spans[kind] = PolyCollection([], facecolors=color, alpha=0.15, linewidths=0, zorder=0.4,
+                                             transform=ax.get_xaxis_transform())
+                ax.add_collection(spans[kind], autolim=False)
+            self.spans.append(spans)
+
+    def update(self, title, daily_min, daily_max, daily_med, file_starts, coverage=None, normals=None):
+        """Replace the plotted data with that of another site"""
+        import matplotlib.dates as mdates
+        import hobo_climatology
+        self.title.set_text('Lava Beds National Monument, Cave I&M - ' + title)
+        x = mdates.date2num(daily_min.index.to_pydatetime())
+
+        for i, (ax, col) in enumerate(zip(self.axes, self.columns)):
+            if self.fills[i] is not None:
+                self.fills[i].remove()
+            self.fills[i] = ax.fill_between(x, daily_min[col].values, daily_max[col].values, color='darkgrey')
+            if self.bands[i] is not None:
+                self.bands[i].remove()
+                self.bands[i] = None
+            if normals is not None and col in hobo_climatology.VARIABLES:
+                lo, hi = [hobo_climatology.normal_for(normals, col, daily_min.index, p) for p in NORMAL_BAND]
+                self.bands[i] = ax.fill_between(x, lo, hi, color='#4daf4a', alpha=0.6, linewidth=0, zorder=1.5)
+            for line, daily in zip(self.lines[i], (daily_min, daily_max, daily_med)):
+                line.set_data(x, daily[col].values)
+            for y, line in self.references[i]:
+                line.set_visible(False)
+            ax.set_autoscale_on(True)  # undo any fixed limits from the previous site
+            ax.relim(visible_only=True)
+            ax.autoscale_view()
+            ymin, ymax = ax.get_ylim()
+
+            if col == 'RH' and ymax > 99.5:
+                # scale Y axis if this is a 100% flatline plot
+                ax.set_ylim(ymin, 101)
+                if ymin >= 90:
+                    ax.set_ylim(89, 101)
+            for y, line in self.references[i]:
+                line.set_visible(ymin <= y <= ymax)
+            if col == 'Battery':
+                ax.set_ylim(2.575, 3.725)
+
+            starts = mdates.date2num(file_starts.to_pydatetime())
+            self.markers[i].set_segments([[(xs, 0), (xs, 1)] for xs in starts])
+            for kind, spans in self.spans[i].items():
+                rows = coverage[coverage['KIND'] == kind] if coverage is not None else []
+                verts = []
+                if len(rows):
+                    for x0, x1 in zip(mdates.date2num(rows['START'].dt.to_pydatetime()), mdates.date2num(rows['END'].dt.to_pydatetime())):
+                        verts.append([(x0, 0), (x0, 1), (x1, 1), (x1, 0)])
+                spans.set_verts(verts)
+
+    def close(self):
+        pyplot.close(self.fig)
+
+
+def hobo_plot(fname, interactive=False, output_format='png', template=None, normals=False):
+    """
+    Plot a file. Batch runs should pass the same `PlotTemplate` for each
+    file, rather than building a new figure every time. With `normals`,
+    the site's day-of-year climatology band is overlaid, if it's been
+    computed by `hobo_climatology.py`.
+    """
+    _import_dependencies(interactive)
+    print 'Plotting %s...' % fname,
+    with metrics.file(fname) as rec:
+        data = load(fname)
+        rec.rows = len(data)
+    # only resample the value columns; min/max of the `FileStart` strings would take Pandas' slow path
+    daily = data[list(PlotTemplate.columns)].resample('D')
+    #daily_avg = daily.mean()
+    daily_med = daily.median()
+    daily_max = daily.max()
+    daily_min = daily.min()
 
     # linear regression line
     #import matplotlib.dates as mdates
@@ -94,89 +225,90 @@ def hobo_plot(fname, interactive=False, output_format='png'):
     #y = poly(x)
     #ax0.plot(daily_med.index, y)
 
-    ax1.set_title('Relative Humidity (%)', fontsize=12)
-    ax1.fill_between(daily_min['RH'].index, daily_min['RH'], daily_max['RH'], color='darkgrey')
-    ax1.plot(daily_min['RH'], color='b')
-    ax1.plot(daily_max['RH'], color='r')
-    ax1.plot(daily_med['RH'], color='black')
-
-    ymin, ymax = ax1.get_ylim()
-    if ymax > 99.5:
-        # scale Y axis if this is a 100% flatline plot
-        ax1.set_ylim(ymin, 101)
-        if ymin >= 90:
-            ax1.set_ylim(89, 101)
-
-    for rh, color in zip([1,25,50,75,100], [(1,0,0), (0.75,0,0.25), (0.5,0,0.5), (0.25,0,0.75), (0,0,1)]):
-        if ymin <= rh <= ymax:
-            ax1.axhline(rh, color=color, linestyle='--', linewidth=0.5, zorder=0.75)
-    ax1.xaxis.set_ticks_position('bottom')
-    pyplot.setp(ax1.get_xticklabels(), fontsize=6, visible=False)
-
-    ax2.set_title('Battery (V)', fontsize=12)
-    ax2.fill_between(daily_min['Battery'].index, daily_min['Battery'], daily_max['Battery'], color='darkgrey')
-    #ax2.plot(daily_min['Battery'][daily_min['FileStart'].isnull()], color='b')
-    #ax2.plot(daily_max['Battery'][daily_min['FileStart'].isnull()], color='r')
-    ax2.plot(daily_min['Battery'], color='b')
-    ax2.plot(daily_max['Battery'], color='r')
-    #ax2.plot(daily_avg['Battery'], color='g')
-    ymin, ymax = ax2.get_ylim()
-    if ymin <= 2.625 <= ymax:
-        ax2.axhline(2.625, color='r', linestyle='--', linewidth=0.5, zorder=0.75)
-    ax2.set_ylim(2.575, 3.725)
-    ax2.xaxis.set_ticks_position('bottom')
-
-    # markers for each individual data logger
     if 'FileStart' in data.columns:
-        for row in data[data['FileStart'].notnull()].itertuples():
-            for ax in ax0, ax1, ax2:
-                ax.axvline(row.Index, linestyle='--', linewidth=0.5, zorder=0.5, color='#808080')
+        file_starts = data.index[data['FileStart'].notnull().values]
+    else:
+        file_starts = data.index[:0]
+
+    # shade coverage gaps and overlaps, from the index written by `hobo_combine_all.py`
+    import hobo_coverage
+    coverage = hobo_coverage.load_coverage(hobo_coverage.coverage_fname(fname))
+    if normals:
+        import hobo_climatology
+        normals = hobo_climatology.load_normals(hobo_climatology.normals_fname(fname))
+    else:
+        normals = None
+
+    own_template = template is None
+    if own_template:
+        template = PlotTemplate()
+    title = os.path.basename(fname).rsplit('.',1)[0].replace('_',' ')
+    template.update(title, daily_min, daily_max, daily_med, file_starts, coverage, normals)
 
     if interactive:
         pyplot.show()
     else:
-        tstart = time()
-        fig.set_size_inches(14, 8.5)
+        template.fig.set_size_inches(14, 8.5)
         outfname = fname.rsplit('.',1)[0]+'.'+output_format
-        pyplot.savefig(outfname, bbox_inches='tight', dpi=150)
-        telapsed = time() - tstart
-        print ' %.2fs render time.' % telapsed,
-    pyplot.close(fig)
+        with metrics.file(outfname, bytes_read=0) as rec:
+            template.fig.savefig(outfname, bbox_inches='tight', dpi=150)
+            rec.bytes_written = os.path.getsize(outfname)
+        print ' %.2fs render time.' % rec.elapsed,
+    if own_template:
+        template.close()
     print
 
 
-def cave_plot(cave):
+def cave_plot(cave, template=None, normals=False):
     """Plot all files for a named cave"""
     for i, site in enumerate(('out', 'ent', 'mid', 'deep')):
         fname = '%s_%s.csv' % (cave, site)
         if os.path.exists(fname):
-            hobo_plot(fname)
+            hobo_plot(fname, template=template, normals=normals)
 
 
-if __name__ == '__main__':
+def main(targets, normals=False):
     from glob import glob
+    from hobo_combine_all import is_site_fname
+
+    interactive = bool(targets) and '_' in targets[0]
+    _import_dependencies(interactive)
 
-    if len(sys.argv) < 2:
+    if not targets:
         # plot every .CSV file we find
-        for fname in glob('*.csv'):
-            hobo_plot(fname)
-    
-    elif sys.argv[1] == '--help':
-        print >> sys.stderr, 'usage:\n' \
-              + '  hobo_plot.py            -  Plot all sites for all caves\n' \
-              + '  hobo_plot.py CAVE_site  -  Plot just one cave-site\n' \
-              + '  hobo_plot.py CAVE       -  Plot all sites for one cave\n'
-        sys.exit(2)
-    
-    elif '_' in sys.argv[1]:
+        with metrics.stage('plot'):
+            template = PlotTemplate()
+            for fname in filter(is_site_fname, glob('*.csv')):
+                hobo_plot(fname, template=template, normals=normals)
+            template.close()
+
+    elif '_' in targets[0]:
         # plot a specific cave site interactively
-        fname = sys.argv[1]
+        fname = targets[0]
         if not fname.endswith('.csv'):
             fname = fname + '.csv'
-        hobo_plot(fname, interactive=True)
-    
+        hobo_plot(fname, interactive=True, normals=normals)
+
     else:
         # plot all sites for a specified cave(s)
-        for cave in sys.argv[1:]:
-            cave_plot(cave)
-        
+        with metrics.stage('plot'):
+            template = PlotTemplate()
+            for cave in targets:
+                cave_plot(cave, template, normals)
+            template.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Create or view plots of cave climate data.',
+        epilog='usage:\n' \
+              + '  hobo_plot.py            -  Plot all sites for all caves\n' \
+              + '  hobo_plot.py CAVE_site  -  Plot just one cave-site\n' \
+              + '  hobo_plot.py CAVE       -  Plot all sites for one cave\n')
+    parser.add_argument('targets', metavar='CAVE', nargs='*', help='cave or CAVE_site to plot (default: all)')
+    parser.add_argument('--normals', action='store_true', help='overlay the day-of-year climatology band from hobo_climatology.py')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.targets, args.normals)
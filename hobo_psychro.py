@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Derived psychrometric variables for cave climate data.
+
+From temperature (F) and relative humidity, computes with the Magnus
+formula (Alduchov & Eskridge 1996 coefficients, over water):
+
+    TemperatureC   temperature (C)
+    DewPoint       dew point temperature (F)
+    AbsHumidity    absolute humidity (g/m^3)
+    VPD            vapor pressure deficit (kPa)
+
+All math is vectorized over whole series with NumPy. Derived columns are
+inserted before `FileStart` in combined cave site files, either as they're
+combined (`hobo_combine_all.py --derived`) or afterwards with this script.
+
+hobo_psychro.py
+    Add (or recompute) derived columns in all combined CAVE_site.csv files in the current directory
+
+hobo_psychro.py CAVE_site.csv...
+    Add derived columns to just the specified files
+
+hobo_psychro.py --strip
+    Remove derived columns again, eg. before archiving with hobo_archive.py
+"""
+
+import os
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+
+MAGNUS_A = 6.1094   # hPa
+MAGNUS_B = 17.625
+MAGNUS_C = 243.04   # C
+WATER_VAPOR_R = 461.5  # J/(kg K), specific gas constant for water vapor
+
+DERIVED_COLUMNS = ['TemperatureC', 'DewPoint', 'AbsHumidity', 'VPD']
+FORMATS = {'TemperatureC': '%.3f', 'DewPoint': '%.3f', 'AbsHumidity': '%.3f', 'VPD': '%.4f'}
+
+
+def f_to_c(temp_f):
+    return (temp_f - 32.0) * (5.0 / 9.0)
+
+def c_to_f(temp_c):
+    return temp_c * (9.0 / 5.0) + 32.0
+
+
+def saturation_vapor_pressure(temp_c):
+    """Saturation vapor pressure (hPa) over water"""
+    import numpy as np
+    return MAGNUS_A * np.exp(MAGNUS_B * temp_c / (MAGNUS_C + temp_c))
+
+
+def derive(temps, rhs):
+    """
+    Compute derived psychrometric variables for whole series at once.
+
+    :param temps:  temperatures (F), array-like with NaN (or None) where missing
+    :param rhs:  relative humidities (%), likewise
+    :return: dict of derived column name -> float64 array, NaN where undefined (eg. RH missing or 0%)
+    """
+    import numpy as np
+    temp_f = np.asarray(temps, dtype=np.float64)
+    rh = np.asarray(rhs, dtype=np.float64)
+    temp_c = f_to_c(temp_f)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rh = np.where(rh > 0, np.minimum(rh, 100.0), np.nan)
+        es = saturation_vapor_pressure(temp_c)
+        e = es * rh / 100.0
+        gamma = np.log(rh / 100.0) + MAGNUS_B * temp_c / (MAGNUS_C + temp_c)
+        dew_c = MAGNUS_C * gamma / (MAGNUS_B - gamma)
+    return {
+        'TemperatureC': temp_c,
+        'DewPoint': c_to_f(dew_c),
+        'AbsHumidity': e * 100.0 / (WATER_VAPOR_R * (temp_c + 273.15)) * 1000.0,  # Pa -> kg/m^3 -> g/m^3
+        'VPD': (es - e) / 10.0,  # hPa -> kPa
+    }
+
+
+def format_columns(derived):
+    """Format derived arrays as lists of CSV field text, empty where undefined"""
+    import numpy as np
+    formatted = []
+    for col in DERIVED_COLUMNS:
+        values = derived[col]
+        text = np.char.mod(FORMATS[col], np.nan_to_num(values))
+        text[np.isnan(values)] = ''
+        formatted.append(text.tolist())
+    return formatted
+
+
+def convert_file(fname, strip=False):
+    """
+    Rewrite a combined file with its derived columns added (or recomputed),
+    or with them removed if `strip`. Other fields are left byte-for-byte
+    as they were. Return the number of rows.
+    """
+    import pandas as pd
+    with metrics.file(fname) as rec:
+        with open(fname, 'rb') as f:
+            text = f.read()
+        newline = '\r\n' if '\r\n' in text[:4096] else '\n'
+        lines = text.split(newline)
+        if lines[-1] == '':
+            lines.pop()
+        header, body = lines[0].split(','), lines[1:]
+        if header[-1] != 'FileStart':
+            raise ValueError('Expected FileStart as the last column of %s' % fname)
+        base = [i for i, col in enumerate(header[:-1]) if col not in DERIVED_COLUMNS]
+        rows = [line.split(',') for line in body]
+        if any(len(row) != len(header) for row in rows):
+            raise ValueError('Unable to parse all %d rows of %s' % (len(body), fname))
+
+        columns = [header[i] for i in base]
+        fields = [[row[i] for i in base] for row in rows]
+        if not strip:
+            temp_i, rh_i = columns.index('Temperature'), columns.index('RH')
+            temps = pd.to_numeric(pd.Series([row[temp_i] for row in fields]), errors='coerce').values
+            rhs = pd.to_numeric(pd.Series([row[rh_i] for row in fields]), errors='coerce').values
+            derived = format_columns(derive(temps, rhs))
+            columns += DERIVED_COLUMNS
+            fields = [row + list(values) for row, values in zip(fields, zip(*derived))]
+
+        tmpfname = fname + '.NEW'
+        with open(tmpfname, 'wb') as outf:
+            outf.write(','.join(columns + ['FileStart']) + newline)
+            for row, src in zip(fields, rows):
+                outf.write(','.join(row + [src[-1]]) + newline)
+            rec.bytes_written = outf.tell()
+        rec.rows = len(rows)
+    os.remove(fname)  # Windows can't rename over an existing file
+    os.rename(tmpfname, fname)
+    return len(rows)
+
+
+def main(fnames, strip=False):
+    if not fnames:
+        from glob import glob
+        from hobo_combine_all import is_site_fname
+        fnames = sorted(filter(is_site_fname, glob('*.csv')))
+    with metrics.stage('psychro'):
+        for fname in fnames:
+            rows = convert_file(fname, strip)
+            print '%s: %s derived columns for %d rows' % (fname, 'removed' if strip else 'added', rows)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Add derived psychrometric columns to combined cave site files')
+    parser.add_argument('fnames', metavar='CAVE_site.csv', nargs='*', help='combined files to convert (default: all)')
+    parser.add_argument('--strip', action='store_true', help='remove derived columns instead')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.fnames, args.strip)
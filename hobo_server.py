@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Local, read-only HTTP query service over combined cave site data.
+
+Series are loaded on first request (from `CAVE_site.csv`, or the compact
+`CAVE_site.hca` archive if there's no CSV), then kept in an in-memory LRU
+cache bounded by total DataFrame size. A cached series is reloaded when
+its file's size or modification time changes, eg. after a re-combine.
+
+All responses are JSON. Time ranges are given with optional `start` and
+`end` query parameters (eg. `2015-01-01` or `2015-01-01 12:00`, inclusive),
+and variables with `vars` (default `Temperature,RH,Battery`).
+
+    GET /sites
+        Available cave sites, and whether each is cached
+    GET /series/CAVE_site?start=&end=&vars=
+        Raw records
+    GET /aggregate/CAVE_site?freq=daily|weekly&stat=mean|median|min|max&start=&end=&vars=
+        Daily or (Monday-based) weekly aggregates
+    GET /stats/CAVE_site?start=&end=&vars=
+        Summary statistics of each variable
+    GET /cache
+        Cache size and hit/miss counts
+
+hobo_server.py [-d DIR] [-p PORT] [--cache-mb MB]
+    Serve the combined files in DIR (default: current directory) on localhost
+"""
+
+import sys, os, os.path
+import re
+import json
+import threading
+from time import time
+from collections import OrderedDict
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from hobo_metrics import metrics
+import hobo_metrics
+
+
+DEFAULT_PORT = 8642
+DEFAULT_CACHE_MB = 512
+VARIABLES = ['Temperature', 'RH', 'Battery']
+FREQUENCIES = {'daily': {'rule': 'D'}, 'weekly': {'rule': 'W-MON', 'closed': 'left', 'label': 'left'}}
+STATS = ['mean', 'median', 'min', 'max']
+SITE_RE = re.compile(r'^[A-Za-z0-9]+_[A-Za-z0-9]+$')
+EXTENSIONS = ['.csv', '.hca']  # in order of preference
+TIME_FMT = '%Y-%m-%d %H:%M:%S'
+DIGITS = 3  # round results to the resolution of our combined files
+
+
+class QueryError(Exception):
+    """A bad request, reported to the client with an HTTP status code"""
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class SeriesCache(object):
+    """
+    Thread-safe LRU cache of loaded site series, evicting the least recently
+    used series once their total in-memory size exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._entries = OrderedDict()  # fname -> (size, mtime, frame, nbytes)
+        self._lock = threading.Lock()
+
+    def __contains__(self, fname):
+        return fname in self._entries
+
+    def get(self, fname):
+        """Loaded DataFrame for a file, reloading it if the file has changed"""
+        st = os.stat(fname)
+        with self._lock:
+            entry = self._entries.pop(fname, None)
+            if entry is not None:
+                self.nbytes -= entry[3]
+                if entry[:2] == (st.st_size, st.st_mtime):
+                    self._entries[fname] = entry  # most recently used
+                    self.nbytes += entry[3]
+                    self.hits += 1
+                    return entry[2]
+            self.misses += 1
+
+        # load outside the lock, so other sites may still be served meanwhile
+        import hobo_plot
+        with metrics.file(fname) as rec:
+            frame = hobo_plot.load(fname)
+            rec.rows = len(frame)
+        nbytes = int(frame.memory_usage(index=True, deep=True).sum())
+
+        with self._lock:
+            old = self._entries.pop(fname, None)
+            if old is not None:
+                self.nbytes -= old[3]
+            self._entries[fname] = (st.st_size, st.st_mtime, frame, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted[3]
+                self.evictions += 1
+        return frame
+
+    def info(self):
+        with self._lock:
+            return {
+                'entries': [{'file': os.path.basename(f), 'bytes': e[3]} for f, e in self._entries.items()],
+                'bytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def _json_values(series):
+    """Series values as a JSON-friendly list, with NaN as null"""
+    return [None if v != v else round(v, DIGITS) for v in series.tolist()]
+
+def _json_times(index):
+    return [ts.strftime(TIME_FMT) for ts in index]
+
+
+class QueryService(object):
+    """Query handlers over the combined files of a directory"""
+
+    def __init__(self, datadir='.', cache_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.datadir = datadir
+        self.cache = SeriesCache(cache_bytes)
+
+    def site_fname(self, site):
+        if not SITE_RE.match(site):
+            raise QueryError('Bad cave site name %r, expected CAVE_site' % site)
+        for ext in EXTENSIONS:
+            fname = os.path.join(self.datadir, site + ext)
+            if os.path.exists(fname):
+                return fname
+        raise QueryError('No data for cave site %s' % site, 404)
+
+    def sites(self, params):
+        sites = {}
+        for basename in sorted(os.listdir(self.datadir)):
+            site, ext = os.path.splitext(basename)
+            if ext.lower() in EXTENSIONS and SITE_RE.match(site) and site not in sites:
+                fname = os.path.join(self.datadir, basename)
+                sites[site] = {'site': site, 'file': basename, 'bytes': os.path.getsize(fname), 'cached': fname in self.cache}
+        return {'sites': [sites[site] for site in sorted(sites)]}
+
+    def _select(self, site, params):
+        """The requested time range and variables of a site's series"""
+        import pandas as pd
+        frame = self.cache.get(self.site_fname(site))
+        variables = params.get('vars', ','.join(VARIABLES)).split(',')
+        unknown = set(variables) - set(VARIABLES)
+        if unknown:
+            raise QueryError('Unknown variable(s): %s' % ', '.join(sorted(unknown)))
+        try:
+            start = pd.Timestamp(params['start']) if 'start' in params else None
+            end = pd.Timestamp(params['end']) if 'end' in params else None
+        except ValueError as e:
+            raise QueryError('Bad time range: %s' % e)
+        if end is not None and len(params['end']) <= 10:
+            end += pd.Timedelta(days=1) - pd.Timedelta(seconds=1)  # a date includes the whole day
+        return frame.loc[start:end, variables], variables
+
+    def series(self, site, params):
+        data, variables = self._select(site, params)
+        result = {'site': site, 'rows': len(data), 'DateTime': _json_times(data.index)}
+        for var in variables:
+            result[var] = _json_values(data[var])
+        return result
+
+    def aggregate(self, site, params):
+        freq, stat = params.get('freq', 'daily'), params.get('stat', 'mean')
+        if freq not in FREQUENCIES:
+            raise QueryError('Unknown frequency %r, expected one of: %s' % (freq, ', '.join(sorted(FREQUENCIES))))
+        if stat not in STATS:
+            raise QueryError('Unknown statistic %r, expected one of: %s' % (stat, ', '.join(STATS)))
+        data, variables = self._select(site, params)
+        opts = dict(FREQUENCIES[freq])
+        agg = getattr(data.resample(opts.pop('rule'), **opts), stat)()
+        result = {'site': site, 'freq': freq, 'stat': stat, 'rows': len(agg), 'DateTime': _json_times(agg.index)}
+        for var in variables:
+            result[var] = _json_values(agg[var])
+        return result
+
+    def stats(self, site, params):
+        data, variables = self._select(site, params)
+        result = {'site': site, 'rows': len(data)}
+        if len(data):
+            result['start'], result['end'] = _json_times([data.index.min(), data.index.max()])
+        for var in variables:
+            col = data[var]
+            result[var] = {'count': int(col.count())}
+            result[var].update((name, None if v != v else round(float(v), DIGITS)) for name, v in (
+                ('min', col.min()), ('median', col.median()), ('mean', col.mean()),
+                ('stddev', col.std(ddof=0)), ('max', col.max())))
+        return result
+
+    def cache_info(self, params):
+        return self.cache.info()
+
+    def query(self, path, params):
+        """Dispatch a request path to its handler, return a JSON-serializable result"""
+        parts = [p for p in path.split('/') if p]
+        if parts == ['sites']:
+            return self.sites(params)
+        if parts == ['cache']:
+            return self.cache_info(params)
+        if len(parts) == 2 and parts[0] in ('series', 'aggregate', 'stats'):
+            return getattr(self, parts[0])(parts[1], params)
+        raise QueryError('Unknown endpoint %s' % path, 404)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Serves GET requests from the server's `QueryService`"""
+
+    def do_GET(self):
+        t0 = time()
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        try:
+            status, body = 200, self.server.service.query(url.path, params)
+        except QueryError as e:
+            status, body = e.status, {'error': str(e)}
+        except Exception as e:
+            status, body = 500, {'error': '%s: %s' % (e.__class__.__name__, e)}
+        payload = json.dumps(body, separators=(',', ':'))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('X-Elapsed-Ms', '%.1f' % ((time() - t0) * 1000))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, fmt, *args):
+        sys.stderr.write('%s - %s\n' % (self.log_date_time_string(), fmt % args))
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.service = service
+
+
+def main(datadir='.', host='127.0.0.1', port=DEFAULT_PORT, cache_mb=DEFAULT_CACHE_MB):
+    service = QueryService(datadir, int(cache_mb * 1024 * 1024))
+    server = QueryServer((host, port), service)
+    print 'Serving cave site data from %s on http://%s:%d/ ...' % (os.path.abspath(datadir), host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Local read-only HTTP query service over combined cave site data')
+    parser.add_argument('-d', '--datadir', default='.', help='directory of combined CAVE_site files (default: current directory)')
+    parser.add_argument('--host', default='127.0.0.1', help='interface to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--cache-mb', type=float, default=DEFAULT_CACHE_MB, help='series cache size limit in MB (default: %(default)s)')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.datadir, args.host, args.port, args.cache_mb)
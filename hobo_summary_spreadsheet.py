@@ -10,6 +10,9 @@ from datetime import datetime
 
 from hobo import HoboCSVReader, timestamp
 
+from hobo_metrics import metrics
+import hobo_metrics
+
 
 SITES = set(['BALC','BOUL','CAST','FERN','FOST','GODO','HOCH','JUHE','LAHO','LOPI','NIIN','NIRV','OVPA','POOF','ROCO','SEAN','SILV','SOLA','VALE','YELL'])
 
@@ -72,7 +75,7 @@ def split_fname(fname):
     basename = os.path.basename(fname)
     toks = basename.split('_')
     cave, site = toks[0], toks[1]
-    season = int([t for t in fname.split('\\') if '20' in t][0].split()[0])  # yuck!
+    season = int([t for t in fname.replace('\\', '/').split('/') if '20' in t][0].split()[0])  # yuck!
     return season, cave, site, basename
 
 
@@ -82,8 +85,10 @@ def warn(s):
 
 def test_file(fname):
     print '\n\n', fname
-    reader = HoboCSVReader(fname)
-    times, temps, rhs, batts = reader.unzip()
+    with metrics.file(fname) as rec:
+        reader = HoboCSVReader(fname)
+        times, temps, rhs, batts = reader.unzip()
+        rec.rows = len(times)
     rhs = [rh for rh in rhs if rh]
     print 'Loaded %d temp and RH rows' % len(temps)
 
@@ -113,16 +118,52 @@ def test_file(fname):
     return red_flag
         
 
-def main():
+def main(rootdir):
     """Test all subfiles and print output"""
-    rootdir = sys.argv[1]
-    for csvfname in find_files(rootdir):
-        test_file(csvfname)
-
-
-def csv_main(outfname=None):
-    """Write a CSV summary output file"""
-    rootdir = sys.argv[1]
+    with metrics.stage('test'):
+        for csvfname in find_files(rootdir):
+            test_file(csvfname)
+
+
+COVERAGE_FIELDS = ['INTERVAL_S', 'DROPPED', 'GAP_BEFORE_DAYS', 'GAP_WITHIN_DAYS', 'OVERLAP_DAYS']
+
+
+def coverage_row(coverage_dir, cache, cave, site, basename):
+    """Look up a file's deployment coverage from the combined file's coverage index"""
+    import hobo_coverage
+    covfname = hobo_coverage.coverage_fname(os.path.join(coverage_dir, '%s_%s.csv' % (cave.upper(), site.lower())))
+    if covfname not in cache:
+        cache[covfname] = hobo_coverage.load_coverage(covfname)
+    if cache[covfname] is None:
+        return ('',) * len(COVERAGE_FIELDS)
+    coverage = hobo_coverage.deployment_coverage(cache[covfname], basename)
+    return tuple(coverage[field] for field in COVERAGE_FIELDS)
+
+
+DERIVED_FIELDS = ['TEMP_C_MEAN', 'DEWPOINT_MIN', 'DEWPOINT_MEAN', 'DEWPOINT_MAX', 'ABS_HUMIDITY_MEAN', 'VPD_MEAN', 'VPD_MAX']
+
+
+def derived_row(temps, rhs):
+    """Summary statistics of derived psychrometric variables, see `hobo_psychro.py`"""
+    import numpy as np
+    import hobo_psychro
+    derived = hobo_psychro.derive(temps, rhs)
+    stats = []
+    for col, funcs in (('TemperatureC', [np.nanmean]), ('DewPoint', [np.nanmin, np.nanmean, np.nanmax]),
+                       ('AbsHumidity', [np.nanmean]), ('VPD', [np.nanmean, np.nanmax])):
+        values = derived[col]
+        for func in funcs:
+            stats.append(round(float(func(values)), 3) if (~np.isnan(values)).any() else '')
+    return tuple(stats)
+
+
+def csv_main(rootdir, outfname=None, coverage_dir=None, derived=False):
+    """
+    Write a CSV summary output file. If `coverage_dir` is specified, the
+    coverage indexes of combined files there are used to add gap and
+    overlap columns. With `derived`, statistics of dew point, absolute
+    humidity, and vapor pressure deficit are added.
+    """
     outfile = sys.stdout if not outfname else open(outfname,'w')
     if outfname:
         print 'Writing CSV output file %s ...' % outfname
@@ -130,13 +171,19 @@ def csv_main(outfname=None):
     print >> outfile, 'SEASON,CAVE,SITE,FNAME,SN,' + \
         'START,END,DAYS,BATT_MIN,' + \
         'TEMP_MIN,TEMP_MED,TEMP_MEAN,TEMP_STDDEV,TEMP_MAX,TEMP_RANGE,' + \
-        'RH_MIN,RH_MED,RH_MEAN,RH_STDDEV,RH_MAX,RH_RANGE,RED_FLAG'
+        'RH_MIN,RH_MED,RH_MEAN,RH_STDDEV,RH_MAX,RH_RANGE,RED_FLAG' + \
+        (','+','.join(COVERAGE_FIELDS) if coverage_dir else '') + \
+        (','+','.join(DERIVED_FIELDS) if derived else '')
+    coverage_cache = {}
     
     for fname in find_files(rootdir):
         print fname, '...'
         season, cave, site, basename = split_fname(fname)
-        reader = HoboCSVReader(fname)
-        times, temps, rhs, batts = reader.unzip()
+        with metrics.file(fname) as rec:
+            reader = HoboCSVReader(fname)
+            times, temps, rhs, batts = reader.unzip()
+            rec.rows = len(times)
+        all_rhs = rhs
         rhs = [rh for rh in rhs if rh is not None]
         if not rhs:
             rhs = [-1, -1]  # hack for empty series
@@ -148,10 +195,26 @@ def csv_main(outfname=None):
                min(rhs), median(rhs), mean(rhs), pstdev(rhs), max(rhs), max(rhs) - min(rhs),
                test_file(fname) or ''
                )
+        if coverage_dir:
+            row += coverage_row(coverage_dir, coverage_cache, cave, site, basename)
+        if derived:
+            row += derived_row(temps, all_rhs)
         print >> outfile, ','.join(str(v) for v in row)
 
+    if outfname:
+        outfile.close()
+
 
 if __name__ == '__main__':
-    #main()
-    csv_main('summary.csv')
+    import argparse
+    parser = argparse.ArgumentParser(description='Write a CSV summary of all HOBO data logger files')
+    parser.add_argument('rootdir', metavar='ROOTDIR', help='directory to search for CSV files')
+    parser.add_argument('-o', '--output', default='summary.csv', help='summary CSV output file (default: summary.csv)')
+    parser.add_argument('--coverage-dir', metavar='DIR', help='directory of combined files, to add coverage columns')
+    parser.add_argument('--derived', action='store_true', help='add dew point, absolute humidity, and VPD statistics columns')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    #hobo_metrics.run(args, main, args.rootdir)
+    hobo_metrics.run(args, csv_main, args.rootdir, args.output, args.coverage_dir, args.derived)
     
\ No newline at end of file
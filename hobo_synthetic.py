@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic archive of HOBO data logger exports, for testing and
+benchmarking our processing scripts without access to real data.
+
+The archive mimics our field season layout, with one HOBOware CSV export
+(and a placeholder .hobo file) per cave site per season:
+
+    2016 Season/Climate/Excel Files/BALC_out_10012345.csv
+    2016 Season/Climate/HOBO Files/BALC_out_10012345.hobo
+
+hobo_synthetic.py [-y YEARS] [-c CAVES] [-i MINUTES] ROOTDIR
+    Generate an archive within ROOTDIR
+
+Data is pseudo-random but deterministic for a given seed. Temperature and
+RH follow a seasonal cycle which is damped with distance into the cave,
+deep sites flatline at 100% RH, and some deployments end with a failing
+battery so that QC truncation has something to find.
+"""
+
+import sys, os, os.path
+import math
+import random
+import zipfile
+import zlib
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+
+
+DEFAULT_CAVES = ['BALC', 'CAST', 'FERN', 'GODO']
+DEFAULT_SITES = ['out', 'ent', 'mid', 'deep']
+DEFAULT_YEARS = 2
+DEFAULT_INTERVAL = 30  # minutes
+FIRST_SEASON = 2014
+BAD_FRACTION = 0.15  # fraction of deployments which end with a dying battery
+
+TZ_OFFSET = '-07:00'  # HOBOware exports in the launching computer's timezone
+DEG = u'\N{DEGREE SIGN}'.encode('utf-8')
+
+# (mean annual temp F, seasonal amplitude F, daily amplitude F, mean RH, RH amplitude) per site
+SITE_CLIMATE = {
+    'out':  (48.0, 20.0, 12.0, 55.0, 30.0),
+    'ent':  (44.0,  9.0,  2.0, 80.0, 15.0),
+    'mid':  (41.0,  3.5,  0.2, 95.0,  6.0),
+    'deep': (39.5,  0.8,  0.0, 101.0, 2.0),
+}
+
+
+def serial_number(cave, site, season):
+    """Deterministic fake logger serial number for a deployment"""
+    return '10%06d' % ((zlib.crc32('%s_%s_%d' % (cave, site, season)) & 0xffffffff) % 1000000)
+
+
+def deployment_period(season):
+    """(start, end) of the deployment retrieved during the named field season"""
+    return datetime(season - 1, 9, 15, 12, 0), datetime(season, 9, 15, 10, 0)
+
+
+def hobo_placeholder(sn, start, end):
+    """
+    Stand-in content for a binary logger file. It's unique to the
+    deployment, so only deliberately copied files look like duplicates.
+    """
+    return ('HOBO synthetic logger file\nS/N %s\n%s\n%s\n' % (sn, start, end)).ljust(64, '\0')
+
+
+def hoboware_header(sn, has_rh=True):
+    """Produce the two HOBOware header lines for a logger export"""
+    cols = ['"#"', '"Date Time, GMT%s"' % TZ_OFFSET,
+            '"Temp, %sF (LGR S/N: %s, SEN S/N: %s)"' % (DEG, sn, sn)]
+    if has_rh:
+        cols.append('"RH, %% (LGR S/N: %s, SEN S/N: %s)"' % (sn, sn))
+    cols += ['"Batt, V (LGR S/N: %s)"' % sn,
+             '"Coupler Detached (LGR S/N: %s)"' % sn,
+             '"Coupler Attached (LGR S/N: %s)"' % sn,
+             '"Stopped (LGR S/N: %s)"' % sn,
+             '"End Of File (LGR S/N: %s)"' % sn]
+    return '"Plot Title: %s "' % sn, ','.join(cols)
+
+
+def generate_rows(site, start, end, interval, rng, failing=False):
+    """
+    Generate (timestamp, temperature, RH, battery) rows for one deployment.
+
+    :param str site:  site name, one of `SITE_CLIMATE`
+    :param datetime start:
+    :param datetime end:
+    :param int interval:  sample interval in minutes
+    :param random.Random rng:
+    :param bool failing:  whether the battery dies near the end of the deployment
+    """
+    t_mean, t_season, t_daily, rh_mean, rh_season = SITE_CLIMATE.get(site, SITE_CLIMATE['mid'])
+    step = timedelta(minutes=interval)
+    n = int((end - start).total_seconds() // step.total_seconds()) + 1
+    fail_at = int(n * rng.uniform(0.85, 0.97)) if failing else n
+    batt0 = rng.uniform(3.55, 3.7)
+    drift = rng.gauss(0, 0.3)
+    ts = start
+    for i in range(n):
+        doy = ts.timetuple().tm_yday
+        hour = ts.hour + ts.minute / 60.0
+        season = math.cos(2 * math.pi * (doy - 200) / 365.25)
+        daily = math.cos(2 * math.pi * (hour - 15) / 24.0)
+        temp = t_mean + drift + t_season * season + t_daily * daily + rng.gauss(0, 0.05 + t_daily / 20.0)
+        rh = rh_mean - rh_season * season - t_daily * daily + rng.gauss(0, 0.5)
+        rh = max(2.0, min(100.0, rh))
+        batt = batt0 - 0.15 * i / float(n) + rng.gauss(0, 0.01)
+        if i >= fail_at:
+            # dying battery: voltage collapses and the sensors read garbage
+            frac = (i - fail_at + 1) / float(n - fail_at)
+            batt -= 1.2 * frac
+            rh = max(0.0, rh * (1 - frac))
+            temp += rng.gauss(0, 40 * frac)
+        yield ts, temp, rh, batt
+        ts += step
+
+
+def write_hoboware_csv(fname, sn, rows, has_rh=True):
+    """Write rows in the HOBOware CSV export format, return number of rows written"""
+    title, header = hoboware_header(sn, has_rh)
+    n = 0
+    with open(fname, 'w') as outf:
+        outf.write(title + '\n')
+        outf.write(header + '\n')
+        for n, (ts, temp, rh, batt) in enumerate(rows, 1):
+            fields = [str(n), ts.strftime('%m/%d/%y %I:%M:%S %p'), '%.3f' % temp]
+            if has_rh:
+                fields.append('%.3f' % rh)
+            fields += ['%.2f' % batt, '', '', '', '']
+            outf.write(','.join(fields) + '\n')
+    return n
+
+
+def season_dirs(rootdir, season):
+    """Create and return (hobodir, csvdir) for a season"""
+    climate = os.path.join(rootdir, '%d Season' % season, 'Climate')
+    hobodir = os.path.join(climate, 'HOBO Files')
+    csvdir = os.path.join(climate, 'Excel Files')
+    for d in hobodir, csvdir:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    return hobodir, csvdir
+
+
+def generate_archive(rootdir, years=DEFAULT_YEARS, caves=DEFAULT_CAVES, sites=DEFAULT_SITES,
+                     interval=DEFAULT_INTERVAL, first_season=FIRST_SEASON, bad_fraction=BAD_FRACTION, seed=0):
+    """
+    Generate a synthetic HOBO archive within `rootdir`.
+
+    :return: list of CSV filenames written
+    """
+    rng = random.Random(seed)
+    fnames = []
+    for season in range(first_season, first_season + years):
+        hobodir, csvdir = season_dirs(rootdir, season)
+        start, end = deployment_period(season)
+        for cave in caves:
+            for site in sites:
+                sn = serial_number(cave, site, season)
+                stem = '%s_%s_%s' % (cave, site, sn)
+                failing = rng.random() < bad_fraction
+                rows = generate_rows(site, start, end, interval, rng, failing)
+                fname = os.path.join(csvdir, stem + '.csv')
+                write_hoboware_csv(fname, sn, rows, has_rh=True)
+                with open(os.path.join(hobodir, stem + '.hobo'), 'wb') as hobof:
+                    hobof.write(hobo_placeholder(sn, start, end))
+                fnames.append(fname)
+    return fnames
+
+
+def _xlsx_col(i):
+    """Zero-based column index to Excel column letters"""
+    letters = ''
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        letters = chr(ord('A') + r) + letters
+    return letters
+
+
+def write_xlsx(fname, sheets):
+    """
+    Write a minimal .XLSX workbook, without requiring an Excel writing library.
+
+    :param sheets:  list of (sheet name, list of row lists); cells may be numbers, strings, or None
+    """
+    xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    ns_main = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    ns_rels = 'http://schemas.openxmlformats.org/package/2006/relationships'
+    ns_docrels = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    ct = 'application/vnd.openxmlformats-officedocument.spreadsheetml'
+
+    types = [xml, '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">',
+             '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>',
+             '<Default Extension="xml" ContentType="application/xml"/>',
+             '<Override PartName="/xl/workbook.xml" ContentType="%s.sheet.main+xml"/>' % ct]
+    workbook = [xml, '<workbook xmlns="%s" xmlns:r="%s"><sheets>' % (ns_main, ns_docrels)]
+    rels = [xml, '<Relationships xmlns="%s">' % ns_rels]
+
+    with zipfile.ZipFile(fname, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i, (name, rows) in enumerate(sheets, 1):
+            types.append('<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="%s.worksheet+xml"/>' % (i, ct))
+            workbook.append('<sheet name="%s" sheetId="%d" r:id="rId%d"/>' % (escape(name), i, i))
+            rels.append('<Relationship Id="rId%d" Type="%s/worksheet" Target="worksheets/sheet%d.xml"/>' % (i, ns_docrels, i))
+            sheet = [xml, '<worksheet xmlns="%s"><sheetData>' % ns_main]
+            for r, row in enumerate(rows, 1):
+                sheet.append('<row r="%d">' % r)
+                for c, value in enumerate(row):
+                    ref = '%s%d' % (_xlsx_col(c), r)
+                    if value is None or value == '':
+                        continue
+                    elif isinstance(value, (int, long, float)):
+                        sheet.append('<c r="%s"><v>%r</v></c>' % (ref, value))
+                    else:
+                        sheet.append('<c r="%s" t="inlineStr"><is><t>%s</t></is></c>' % (ref, escape(str(value))))
+                sheet.append('</row>')
+            sheet.append('</sheetData></worksheet>')
+            z.writestr('xl/worksheets/sheet%d.xml' % i, ''.join(sheet))
+        types.append('</Types>')
+        workbook.append('</sheets></workbook>')
+        rels.append('</Relationships>')
+        z.writestr('[Content_Types].xml', ''.join(types))
+        z.writestr('_rels/.rels', xml + '<Relationships xmlns="%s"><Relationship Id="rId1" '
+                   'Type="%s/officeDocument" Target="xl/workbook.xml"/></Relationships>' % (ns_rels, ns_docrels))
+        z.writestr('xl/workbook.xml', ''.join(workbook))
+        z.writestr('xl/_rels/workbook.xml.rels', ''.join(rels))
+
+
+def generate_ice_workbook(fname, rooms=3, points=60, transects=True, seed=0):
+    """
+    Generate a synthetic ice monitoring workbook in the format `ice_process.py` expects:
+    a "Tie-In" sheet plus perimeter (and optionally transect) survey sheets per room.
+    """
+    rng = random.Random(seed)
+    letters = [chr(ord('A') + i) for i in range(rooms)]
+    tiein = [['From', 'To', 'Dist m', 'Azm', 'Inc', 'Alt m', 'UTM East', 'UTM North', 'Comment'],
+             ['FX', letters[0] + '0', 12.5, 135.0, -15.0, None, None, None, 'entrance to first tripod'],
+             ['BM', 'FX', 0.0, 0.0, 0.0, 1301.25, 613402.0, 4621873.0, 'benchmark']]
+    for prev, room in zip(letters, letters[1:]):
+        tiein.append([prev + '0', room + '0', rng.uniform(5, 20), rng.uniform(0, 360), rng.uniform(-10, 10), None, None, None, ''])
+
+    survey_header = ['Point', 'Azm', 'Dist m', 'Inc', 'Down m', 'Back m', 'Comment']
+    sheets = [('Tie-In', tiein)]
+    for room in letters:
+        perimeter = [survey_header]
+        for i in range(points):
+            azm = 360.0 * i / points
+            perimeter.append([i + 1, azm, rng.uniform(3, 8), rng.uniform(-25, -5),
+                              rng.choice([None, 0.25, 0.5]), None, ''])
+        perimeter.append([None, None, None, None, None, None, 'end of perimeter'])
+        sheets.append(('%s Ice Perimeter' % room, perimeter))
+        if transects:
+            transect = [survey_header]
+            azm = rng.uniform(0, 360)
+            for i in range(points // 2):
+                transect.append([i + 1, azm, 0.25 * (i + 1), rng.uniform(-30, -5), None, None, ''])
+            sheets.append(('%s Ice Transect' % room, transect))
+    write_xlsx(fname, sheets)
+    return fname
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate a synthetic HOBO data logger archive')
+    parser.add_argument('rootdir', metavar='ROOTDIR', help='directory to generate the archive within')
+    parser.add_argument('-y', '--years', type=int, default=DEFAULT_YEARS, help='number of field seasons')
+    parser.add_argument('-c', '--caves', default=','.join(DEFAULT_CAVES), help='comma-separated cave list')
+    parser.add_argument('-s', '--sites', default=','.join(DEFAULT_SITES), help='comma-separated site list')
+    parser.add_argument('-i', '--interval', type=int, default=DEFAULT_INTERVAL, help='sample interval in minutes')
+    parser.add_argument('--first-season', type=int, default=FIRST_SEASON, help='first field season year')
+    parser.add_argument('--bad-fraction', type=float, default=BAD_FRACTION, help='fraction of failing deployments')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--ice', action='store_true', help='also generate a synthetic ice monitoring workbook')
+    args = parser.parse_args()
+
+    fnames = generate_archive(args.rootdir, args.years, args.caves.split(','), args.sites.split(','),
+                              args.interval, args.first_season, args.bad_fraction, args.seed)
+    print 'Generated %d HOBO CSV files in %s' % (len(fnames), args.rootdir)
+    if args.ice:
+        fname = generate_ice_workbook(os.path.join(args.rootdir, 'ice_survey.xlsx'), seed=args.seed)
+        print 'Generated ice workbook', fname
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,9 @@ import fnmatch
 import csv
 from datetime import datetime
 
+from hobo_metrics import metrics
+import hobo_metrics
+
 
 SITES = set(['BALC','BOUL','CAST','FERN','FOST','GODO','HOCH','JUHE','LAHO','LOPI','NIIN','NIRV','OVPA','POOF','ROCO','SEAN','SILV','SOLA','VALE','YELL'])
 
@@ -58,6 +61,21 @@ def copy(fname):
     outfname = fname + '.NEW.csv'
     bakfname = fname + '.BAK'
     permfname = fname.rsplit('.',1)[0] + '_cropped.csv'
+    with metrics.file(fname) as rec:
+        truncated = _copy(fname, outfname, rec)
+
+    # back up original and rename new truncated file
+    if not truncated:
+        os.remove(outfname)
+    else:
+        print 'Renaming truncated %s to %s .' % (os.path.basename(fname), os.path.basename(permfname))
+        os.rename(fname, bakfname)
+        os.rename(outfname, permfname)
+    return truncated
+
+
+def _copy(fname, outfname, rec):
+    """Copy `fname` to `outfname` until we reach bad data, return whether we truncated"""
     inf = open(fname, 'rt')
     outf = open(outfname, 'w')
     truncated = False
@@ -92,19 +110,26 @@ def copy(fname):
             truncated = True
             break
         outf.write(line)
+        rec.rows += 1
 
-    # back up original and rename new truncated file
+    rec.bytes_written = outf.tell()
     outf.close()
     inf.close()
-    if not truncated:
-        os.remove(outfname)
-    else:
-        print 'Renaming truncated %s to %s .' % (os.path.basename(fname), os.path.basename(permfname))
-        os.rename(fname, bakfname)
-        os.rename(outfname, permfname)
+    return truncated
+
+
+def main(rootdir):
+    with metrics.stage('truncate'):
+        for fname in rglob(rootdir, '*.csv'):
+            copy(fname)
 
 
 if __name__ == '__main__':
-    for fname in rglob(sys.argv[1], '*.csv'):
-        copy(fname)
+    import argparse
+    parser = argparse.ArgumentParser(description='Truncate HOBO CSV files at the first sign of bad data')
+    parser.add_argument('rootdir', metavar='ROOTDIR', help='directory to search for CSV files')
+    hobo_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    hobo_metrics.run(args, main, args.rootdir)
     
\ No newline at end of file
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """
-usage: ice2dat.py [-d DATE] [-t TEAM] [-m DECLINATION] [-c CAVE] EXCELFILE
+usage: ice2dat.py [-d DATE] [-t TEAM] [-m DECLINATION] [-c CAVE] [--no-grid]
+                  [--profile FILE] [--metrics-json FILE] EXCELFILE
 
 Convert ice monitoring data into Compass survey
 
@@ -14,6 +15,9 @@ optional arguments:
   -m DECLINATION, --declination DECLINATION
                         magnetic declination
   -c CAVE, --cave CAVE  cave name
+  --no-grid             skip GDAL raster grid and contour generation
+  --profile FILE        write cProfile statistics to FILE
+  --metrics-json FILE   write timing and resource metrics to FILE as JSON
 
 
 Input File Format
@@ -72,9 +76,10 @@ import math
 import csv
 import subprocess
 
-import xlrd
+# xlrd and pyshp are imported where needed, so that `--help` starts quickly
 
-import shapefile
+from hobo_metrics import metrics
+import hobo_metrics
 
 
 class ExcelWorksheetReader(object):
@@ -86,16 +91,78 @@ class ExcelWorksheetReader(object):
 
     def __init__(self, worksheet):
         self.sheet = worksheet
-        self.headers = [header.value for header in worksheet.row(0)]
-    
+        self.headers = worksheet.row_values(0)
+
     def __iter__(self):
+        headers = self.headers
         for i in range(1, self.sheet.nrows):
-            yield dict(zip(self.headers, [col.value for col in self.sheet.row(i)]))
+            yield dict(zip(headers, self.sheet.row_values(i)))
+
+
+class ExcelColumnReader(object):
+    """
+    A column-oriented reader over an XLRD Excel Worksheet
+
+    Rather than building a dict for every row, whole columns are pulled out
+    of the worksheet once and cached, optionally converted to a Python type.
+    Blank cells are replaced with a default value.
+
+    The worksheet's first row must be column headers.
+    """
+
+    def __init__(self, worksheet):
+        self.name = worksheet.name
+        self.sheet = worksheet
+        self.headers = worksheet.row_values(0) if worksheet.nrows else []
+        self.nrows = max(worksheet.nrows - 1, 0)
+        self._columns = {}
+
+    def __contains__(self, header):
+        return header in self.headers
+
+    def __len__(self):
+        return self.nrows
+
+    def column(self, header, type_=None, default=None):
+        """
+        Produce a list of all data values for the named column.
+
+        :param str header:  column header name
+        :param type_:  callable used to convert non-blank cell values, eg. `float`
+        :param default:  value used for blank cells, or if the column is missing entirely
+        :rtype: list
+        """
+        key = header, type_, default
+        if key not in self._columns:
+            if header not in self.headers:
+                values = [default] * self.nrows
+            else:
+                values = self.sheet.col_values(self.headers.index(header), start_rowx=1)
+                if type_ is None:
+                    values = [default if v == '' else v for v in values]
+                else:
+                    values = [default if v == '' else type_(v) for v in values]
+            self._columns[key] = values
+        return self._columns[key]
+
+    def columns(self, headers, type_=None, default=None):
+        """Produce a list of column value lists for each of the named headers"""
+        return [self.column(header, type_, default) for header in headers]
+
+    def __iter__(self):
+        """Iterate as `csv.DictReader` compatible row dicts, for callers which need them"""
+        headers = self.headers
+        for values in zip(*self.columns(headers, default='')):
+            yield dict(zip(headers, values))
 
 
+def _sheet_name(sheet):
+    """Sheet predicates accept either an XLRD worksheet or just its name"""
+    return getattr(sheet, 'name', sheet)
+
 def is_tiein_survey(sheet):
     """Is this worksheet a "tie-in survey"?"""
-    return sheet.name.replace('-','').lower() == 'tiein'
+    return _sheet_name(sheet).replace('-','').lower() == 'tiein'
 
 def is_perimeter_survey(sheet):
     """Is this worksheet a main "perimiter survey"?"""
@@ -103,30 +170,46 @@ def is_perimeter_survey(sheet):
 
 def is_transect_survey(sheet):
     """Is this worksheet a secondary "transect survey"?"""
-    return 'transect' in sheet.name.lower()
+    return 'transect' in _sheet_name(sheet).lower()
+
+def iter_sheets(workbook, predicate=None):
+    """
+    Produce the worksheets of a workbook matching `predicate`, in order.
+
+    Worksheets are filtered by name, then loaded one at a time. When the
+    workbook was opened with `on_demand=True`, each worksheet is released
+    again once the caller moves on to the next one.
+    """
+    for name in workbook.sheet_names():
+        if predicate and not predicate(name):
+            continue
+        loaded = workbook.sheet_loaded(name)
+        yield workbook.sheet_by_name(name)
+        if not loaded and workbook.on_demand:
+            workbook.unload_sheet(name)
 
 def find_tiein_sheet(workbook):
     """Given an Excel workbook, find the "tie-in sheet"."""
-    for sheet in workbook.sheets():
-        if is_tiein_survey(sheet):
-            return sheet
+    for name in workbook.sheet_names():
+        if is_tiein_survey(name):
+            return workbook.sheet_by_name(name)
     raise Exception('No tie-in survey sheet found!')
 
 def find_survey_sheets(workbook):
     """Produce the individual survey sheets from an Excel workbook"""
-    return filter(lambda s: not is_tiein_survey(s), workbook.sheets())
+    return iter_sheets(workbook, lambda s: not is_tiein_survey(s))
 
 def find_perimeter_survey_sheets(workbook):
     """Produce just the "perimeter survey" sheets from a workbook"""
-    return filter(is_perimeter_survey, workbook.sheets())
+    return iter_sheets(workbook, is_perimeter_survey)
 
 def find_transect_survey_sheets(workbook):
     """Produce just the "transect survey" sheets from a workbook"""
-    return filter(is_transect_survey, workbook.sheets())
+    return iter_sheets(workbook, is_transect_survey)
 
 def tripod_station_name(sheet):
     """Guess a worksheet's tripod survey station name"""
-    return sheet.name.split()[0] + '0'
+    return _sheet_name(sheet).split()[0] + '0'
 
 
 def gdal_grid(perimeter_fname, point_fname, output_grid_fname):
@@ -237,23 +320,30 @@ def excel_tiein(sheet, declination=0.0):
     """Produce a dict of station -> coordinate from our "tie-in survey"."""
     # TODO: support magnetic declination correction
 
+    columns = sheet if isinstance(sheet, ExcelColumnReader) else ExcelColumnReader(sheet)
+    froms, tos = columns.columns(('From', 'To'))
+    alts = columns.column('Alt m')
+    easts, norths = columns.columns(('UTM East', 'UTM North'), default=0)
+
     stations = {}
 
-    for row in ExcelWorksheetReader(sheet):
-        stations[row['From']] = stations.get(row['From'], None)
-        if row.get('Alt m', None) not in (None, ''):
-            print('Found fixed station!  %s' % row)
-            stations[row['To']] = Point(row.get('UTM East',0), row.get('UTM North',0), row.get('Alt m',0))
+    for from_, to, alt, east, north in zip(froms, tos, alts, easts, norths):
+        stations[from_] = stations.get(from_, None)
+        if alt is not None:
+            print('Found fixed station!  %s -> %s  (%s, %s, %s)' % (from_, to, east, north, alt))
+            stations[to] = Point(east, north, alt)
         else:
-            stations[row['To']] = stations.get(row['To'], None)
+            stations[to] = stations.get(to, None)
+
+    # as in excel_survey(), convert only rows which are actual shots (a zero distance is still a shot,
+    # eg. from a benchmark to a fixed station); a blank Azm or Inc on a shot raises
+    shots = [(from_, to, float(dist), float(azm), float(inc))
+             for from_, to, dist, azm, inc in zip(froms, tos, *columns.columns(('Dist m', 'Azm', 'Inc'), default=''))
+             if dist != '']
 
     passes = 0
     while None in stations.values():
-        for row in ExcelWorksheetReader(sheet):
-            from_, to = row['From'], row['To']
-            azm, inc = float(row['Azm']), float(row['Inc'])
-            dist, comment = row['Dist m'], row['Comment']
-
+        for from_, to, dist, azm, inc in shots:
             from_p, to_p = stations.get(from_, None), stations.get(to, None)
             if from_p and to_p:
                 continue
@@ -270,26 +360,45 @@ def excel_tiein(sheet, declination=0.0):
     return stations
 
 
-def excel_survey(sheet, origin):
-    for row in ExcelWorksheetReader(sheet):
-        if not row.get('Dist m', None):
-            continue  # skip blanks
-        name = row.get('Point', '')
-        dist, azm, inc = float(row['Dist m']), float(row['Azm']), float(row['Inc'])
-        down, back = row.get('Down m', 0.0), row.get('Back m', 0.0)
-        yield origin.shot(dist, azm, inc, down=down, back=back, name=name)
+SURVEY_COLUMNS = 'Dist m', 'Azm', 'Inc', 'Down m', 'Back m'
 
 
-def process(excelfname, **kwargs):
+def excel_survey(columns, origin):
+    """
+    Produce the surveyed points of a worksheet, shot from `origin`.
+
+    :param ExcelColumnReader columns:  survey worksheet columns (an XLRD worksheet is also accepted)
+    :param Point origin:  tripod station location
+    """
+    if not isinstance(columns, ExcelColumnReader):
+        columns = ExcelColumnReader(columns)
+    names = columns.column('Point', default='')
+    dists, azms, incs, downs, backs = columns.columns(SURVEY_COLUMNS, default='')
+    for name, dist, azm, inc, down, back in zip(names, dists, azms, incs, downs, backs):
+        if not dist:
+            continue  # skip blanks, converting only the rows which are actual shots
+        # a blank Azm or Inc on a shot is missing data, so let float() raise rather than default it
+        yield origin.shot(float(dist), float(azm), float(inc), down=float(down or 0.0), back=float(back or 0.0), name=name)
+
+
+def process(excelfname, grid=True, **kwargs):
     """
     Process an Excel workbook and export the following files:
 
     1. ESRI Shapefile polygon layer of ice perimeter
     2. ESRI Shapefile point layer of all ice surface points
     3. CSV file of all ice surface points
+    4. GeoTIFF interpolated raster grid and contour Shapefile (unless `grid` is False)
     """
+    import xlrd
+    import shapefile
+
     basename = os.path.splitext(excelfname)[0]
-    book = xlrd.open_workbook(excelfname)
+    with metrics.file(excelfname) as rec:
+        book = xlrd.open_workbook(excelfname, on_demand=True)
+        tiein = ExcelColumnReader(find_tiein_sheet(book))
+        fixed_stations = excel_tiein(tiein)
+        rec.rows = len(tiein)
 
     out_perimeter = shapefile.Writer(shapefile.POLYGONZ)
     out_perimeter.autobalance = True
@@ -303,33 +412,37 @@ def process(excelfname, **kwargs):
     out_csv = csv.writer(open(basename+'_points.csv', 'wb'))
     out_csv.writerow(['X', 'Y', 'Z'])
 
-    fixed_stations = excel_tiein(find_tiein_sheet(book))
-
-    for sheet in find_survey_sheets(book):
-        origin = fixed_stations[tripod_station_name(sheet)]
-
-        if is_perimeter_survey(sheet):
-            print(sheet.name, '(perimeter)')
-            points = list(excel_survey(sheet, origin))
-            for p in points:
-                out_points.record(p.name, p.z)
-                out_points.point(*p.coords)
-                out_csv.writerow(p.coords)
-            out_perimeter.record(sheet.name)
-            out_perimeter.poly([[p.coords for p in points]])
-
-        elif is_transect_survey(sheet):
-            print(sheet.name, '(transect)')
-            for p in excel_survey(sheet, origin):
-                out_points.record(p.name, p.z)
-                out_points.point(*p.coords)
-                out_csv.writerow(p.coords)
+    with metrics.stage('survey') as stage:
+        for sheet in find_survey_sheets(book):
+            origin = fixed_stations[tripod_station_name(sheet)]
+            columns = ExcelColumnReader(sheet)
+            stage.rows += len(columns)
+
+            if is_perimeter_survey(sheet):
+                print(sheet.name, '(perimeter)')
+                points = list(excel_survey(columns, origin))
+                for p in points:
+                    out_points.record(p.name, p.z)
+                    out_points.point(*p.coords)
+                    out_csv.writerow(p.coords)
+                out_perimeter.record(sheet.name)
+                out_perimeter.poly([[p.coords for p in points]])
+
+            elif is_transect_survey(sheet):
+                print(sheet.name, '(transect)')
+                for p in excel_survey(columns, origin):
+                    out_points.record(p.name, p.z)
+                    out_points.point(*p.coords)
+                    out_csv.writerow(p.coords)
 
     out_perimeter.save(basename+'_perimeter.shp')
     out_points.save(basename+'_points.shp')
+    book.release_resources()
 
-    gdal_grid(basename+'_perimeter.shp', basename+'_points.shp', basename+'_grid.tif')
-    gdal_contour(basename+'_grid.tif', basename+'_contour.shp')
+    if grid:
+        with metrics.stage('grid'):
+            gdal_grid(basename+'_perimeter.shp', basename+'_points.shp', basename+'_grid.tif')
+            gdal_contour(basename+'_grid.tif', basename+'_contour.shp')
 
 
 def main():
@@ -340,12 +453,14 @@ def main():
     parser.add_argument('-t', '--team', help='survey team list')
     parser.add_argument('-m', '--declination', help='magnetic declination', type=float, default=0.0)
     parser.add_argument('-c', '--cave', help='cave name', default='')
+    parser.add_argument('--no-grid', help='skip GDAL raster grid and contour generation', dest='grid', action='store_false')
+    hobo_metrics.add_arguments(parser)
     
     args = parser.parse_args()
     date = datetime.datetime.strptime(args.date, '%Y-%m-%d').date() if args.date else None
     team = args.team.split(',') if args.team else []
     
-    process(args.file, date=date, declination=args.declination, team=team, cave_name=args.cave)
+    hobo_metrics.run(args, process, args.file, grid=args.grid, date=date, declination=args.declination, team=team, cave_name=args.cave)
 
 
 if __name__ == '__main__':